@@ -0,0 +1,143 @@
+"""
+Caching of the substitute lookups, in the 'substitutes' cache of
+settings.CACHES, and of the autocomplete answers, in its 'autocomplete'
+cache. Entries are keyed by catalog version, and by product id or search
+key. The version is read from the database on each lookup, so a bump
+(see catalog.rebuild) makes every entry stale at once in every process,
+without a scan, and the backend evicts them in time.
+"""
+from collections import OrderedDict
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from openfood.models import CatalogVersion, Product
+from openfood.text import search_key
+
+import hashlib
+import json
+import pickle
+import threading
+import time
+
+CACHED_SUBSTITUTES = 12
+
+
+class LRUMemoryCache(BaseCache):
+    """
+    Per-process memory cache backend evicting the least recently used
+    entries beyond OPTIONS['MAX_ENTRIES'], and entries older than their
+    timeout. Django's LocMemCache culls at random instead.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(params)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            if self.get_entry(key) is not None:
+                return False
+            self.set_entry(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            entry = self.get_entry(key)
+        if entry is None:
+            return default
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            self.set_entry(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            return self.get_entry(key) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_entry(self, key):
+        """
+        Return the (expiry, pickled value) entry of [key] and mark it as
+        the most recently used, or None if it is missing or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def set_entry(self, key, value, timeout):
+        self.entries[key] = (
+            self.get_backend_timeout(timeout), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self._max_entries:
+            self.entries.popitem(last=False)
+
+
+def substitutes_key(pk, version):
+    return 'substitutes:{}:{}'.format(version, pk)
+
+
+def get_substitutes(pk, number=6, exclude=(), version=None):
+    """
+    Return Product.objects.get_substitutes([pk], [number], [exclude]), for
+    the catalog [version], read from the database if not given.
+    The cache holds the CACHED_SUBSTITUTES best substitutes of [pk]: the
+    [exclude] ids are taken out of them, and when too few are left the
+    page is topped up with live substitutes (see ProductManager.top_up).
+    """
+    cache = caches['substitutes']
+    if version is None:
+        version = CatalogVersion.objects.get_version()
+    key = substitutes_key(pk, version)
+    context = cache.get(key)
+    if context is None:
+        context = Product.objects.get_substitutes(pk, CACHED_SUBSTITUTES)
+        cache.set(key, context)
+    cached = context['substitutes'] or []
+    substitutes = [substitute for substitute in cached if substitute.pk not in exclude]
+    if len(substitutes) < min(number, len(cached)):
+        substitutes = Product.objects.top_up(context['product'], substitutes, number, exclude)
+    context['substitutes'] = substitutes[:number] or None
+    return context
+
+
+def autocomplete_key(term, version):
+    key = search_key(term).encode()
+    return 'autocomplete:{}:{}'.format(version, hashlib.md5(key).hexdigest())
+
+
+def get_autocomplete(term, index):
+    """
+    Return the JSON list of the product names of grade B to E starting
+    with [term], from the catalog [index]. Terms sharing a search key
+    share their cache entry.
+    """
+    cache = caches['autocomplete']
+    key = autocomplete_key(term, index.version)
+    data = cache.get(key)
+    if data is None:
+        data = json.dumps(index.autocomplete(term, grades='bcde'))
+        cache.set(key, data)
+    return data
@@ -0,0 +1,16 @@
+from openfood import search
+from openfood.models import CatalogVersion, Substitute
+
+
+def rebuild():
+    """
+    Rebuild the data derived from the catalog, then bump its version so
+    that everything cached from the previous one is out of date.
+    Return the numbers of rows built and the new version.
+    """
+    report = {
+        'substitutes': Substitute.objects.rebuild(),
+        'search_index': search.rebuild(),
+        }
+    report['version'] = CatalogVersion.objects.bump()
+    return report
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import shutil
+
+
+class Checkpoint:
+    """
+    Progress of a refresh run, saved in [directory] so that an interrupted
+    run can be resumed:
+    - state.json tells whether the database was emptied and which
+      category & grade units are registered,
+    - units/<unit>.json holds the products fetched for each unit.
+    Every file is written atomically.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.state = {'emptied': False, 'registered': []}
+        os.makedirs(os.path.join(directory, 'units'), exist_ok=True)
+        try:
+            with open(self.path('state.json'), encoding='utf-8') as state:
+                self.state = json.load(state)
+        except (OSError, ValueError):
+            pass
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def unit_path(self, unit):
+        key = hashlib.sha1(json.dumps(list(unit)).encode('utf-8')).hexdigest()
+        return self.path('units', key + '.json')
+
+    def write(self, path, data):
+        temporary = path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as checkpoint:
+            json.dump(data, checkpoint)
+        os.replace(temporary, path)
+
+    def save_state(self):
+        self.write(self.path('state.json'), self.state)
+
+    def load(self, unit):
+        """
+        Return the products fetched for [unit], or None.
+        """
+        try:
+            with open(self.unit_path(unit), encoding='utf-8') as products:
+                return json.load(products)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, unit, products):
+        self.write(self.unit_path(unit), products)
+
+    @property
+    def emptied(self):
+        return self.state['emptied']
+
+    def mark_emptied(self):
+        self.state['emptied'] = True
+        self.save_state()
+
+    def is_registered(self, unit):
+        return list(unit) in self.state['registered']
+
+    def mark_registered(self, unit):
+        self.state['registered'].append(list(unit))
+        self.save_state()
+
+    def clear(self):
+        """
+        Forget everything: the next run starts from scratch.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(os.path.join(self.directory, 'units'), exist_ok=True)
+        self.state = {'emptied': False, 'registered': []}
@@ -0,0 +1,584 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.db import connection, transaction
+from openfood import catalog
+from openfood.models import Product, Category, Position, StagedProduct, StagedPosition
+from openfood.off_client import OffClient, SEARCH_URL
+from openfood.text import search_key
+
+
+PRODUCT_KEYS = [
+    'product_name', 'nutrition_grades', 'url', 'code', 'brands', 'stores',
+    'categories_hierarchy', 'image_url',
+    ]
+# Product model field: Open Food Facts key.
+PRODUCT_FIELDS = OrderedDict([
+    ('product_name', 'product_name'),
+    ('grade', 'nutrition_grades'),
+    ('url', 'url'),
+    ('barcode', 'code'),
+    ('brand', 'brands'),
+    ('store', 'stores'),
+    ('product_img_url', 'image_url'),
+    ])
+
+
+def product_fields(product):
+    """
+    Return the Product model fields of a fetched [product], with its
+    search key.
+    """
+    fields = {field: product[key] for field, key in PRODUCT_FIELDS.items()}
+    fields['barcode'] = str(fields['barcode'])
+    fields['search_key'] = search_key(fields['product_name'])
+    return fields
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Collector:
+    """
+    Get products from Open Food Facts database.
+    Register fields for 'Products' & 'Categories'.
+    The many to many connection table 'Position' contains 'rank' field,
+    according to the position of each category in the product hierarchy.
+    """
+
+    def __init__(self, url=SEARCH_URL,
+            number_by_grade=[
+                ('a', 10), ('b', 10), ('c', 10), ('d', 10), ('e', 10)
+                ],
+                categories=[
+                    "Salty snacks", "Cheeses", "Beverage", "Sauces",
+                    "Biscuits", "Frozen foods", "pizzas", "chocolats",
+                    "Candies", "Snacks sucrés",],
+                page_size=None, stream=True, bulk=True, batch_size=500, workers=8,
+                timeout=(3.05, 30), retries=3, cache=None,
+            ):
+        self.url = url
+        self.workers = workers
+        self.client = OffClient(url=url, timeout=timeout, retries=retries,
+            pool_size=workers, cache=cache)
+        self.grades = number_by_grade
+        self.categories = categories
+        self.page_size = page_size or (100 if stream else 1000)
+        self.stream = stream
+        self.bulk = bulk
+        self.batch_size = batch_size
+        self.products = []
+        self.index = {}
+        self.duplicates = 0
+        self.fetched = OrderedDict()
+
+    def fetch(self, category="Cheese", grade="a", products_number=50,
+            product_keys=PRODUCT_KEYS):
+        """
+        Get [products_number] products in  [category] & grade [grade,
+        keep only the needed fields listed in [product_keys].
+        """
+        self.add_products(self.fetch_products(
+            category, grade, products_number, product_keys))
+
+    def add_products(self, products):
+        """
+        Add fetched [products] to the ones to register, once per barcode:
+        a product fetched again, under another category, gets its
+        categories hierarchy merged into the one already added.
+        [index] maps each barcode to the position of its product.
+        """
+        for product in products:
+            barcode = str(product['code'])
+            position = self.index.get(barcode)
+            if position is None:
+                self.index[barcode] = len(self.products)
+                self.products.append(product)
+                continue
+            self.duplicates += 1
+            known = self.products[position]
+            hierarchy = known['categories_hierarchy']
+            merged = hierarchy + [
+                category for category in product['categories_hierarchy']
+                if category not in hierarchy
+                ]
+            if len(merged) != len(hierarchy):
+                self.products[position] = dict(known, categories_hierarchy=merged)
+
+    def fetch_products(self, category, grade, products_number,
+            product_keys=PRODUCT_KEYS):
+        """
+        Same as fetch() but return the products instead of storing them,
+        so it can run in a worker thread.
+        In stream mode, pages of [page_size] products are read one product
+        at a time and no more page is requested once the number is reached.
+        Otherwise, a single page of [page_size] products is loaded.
+        """
+        args = {
+            'action': "process",
+            'tagtype_0': "categories",
+            'tag_contains_0': "contains",
+            'tag_0': category,
+            'nutrition_grades': grade,
+            'json': 1,
+            }
+        if self.stream:
+            products = self.client.iter_search(args, page_size=self.page_size)
+        else:
+            args['page_size'] = self.page_size
+            products = self.client.search(args)["products"]
+        products_to_store = []
+        for product in products:
+            product_to_store = {}
+            try:
+                for key in product_keys:
+                    product_to_store[key] = product[key]
+                products_to_store.append(product_to_store)
+            except KeyError:
+                # print("Key Error on {}.".format(key))
+                pass
+
+            if len(products_to_store) == products_number:
+                print("Number reached !!!")
+                break
+
+        if self.stream:
+            products.close()
+        return products_to_store
+
+    def register(self):
+        """
+        Register products one by one: one query per product, category
+        and position. Kept for small imports and debugging.
+        """
+        for product in self.products:
+            new_product = Product.objects.filter(barcode=product['code']).first()
+            if new_product is None:
+                new_product = Product()
+            else:
+                new_product.position_set.all().delete()
+            new_product.product_name = product['product_name']
+            new_product.grade = product['nutrition_grades']
+            new_product.url = product['url']
+            new_product.barcode = product['code']
+            new_product.brand = product['brands']
+            new_product.store = product['stores']
+            new_product.product_img_url = product['image_url']
+            new_product.save()
+
+            for i, category in enumerate(product['categories_hierarchy'][::-1]):
+                new_category = Category.objects.get_or_create(
+                    category_name=category,
+                )
+                new_position = Position()
+                new_position.product = new_product
+                new_position.category = new_category[0]
+                new_position.rank = i
+                new_position.save()
+
+    def register_bulk(self):
+        """
+        Register all products with batched inserts, in one transaction.
+        Categories are resolved through a name -> id map built in memory,
+        so each table is written with a handful of queries whatever
+        the number of products.
+        """
+        with transaction.atomic():
+            self.insert_catalog(self.products)
+
+    def insert_catalog(self, products):
+        """
+        Bulk insert [products] (as fetched) with their positions.
+        Products already registered under their barcode, such as the
+        favorites kept by empty(), are updated and get their positions
+        rewritten instead.
+        """
+        barcodes = [str(product['code']) for product in products]
+        existing = {}
+        for chunk in chunks(barcodes, self.batch_size):
+            existing.update(Product.objects.filter(barcode__in=chunk).values_list('barcode', 'pk'))
+        new_products = [
+            product for barcode, product in zip(barcodes, products) if barcode not in existing
+            ]
+        product_ids = dict(existing)
+        product_ids.update(zip(
+            (str(product['code']) for product in new_products),
+            self.insert_products([Product(**product_fields(product)) for product in new_products]),
+            ))
+        for barcode, product in zip(barcodes, products):
+            if barcode in existing:
+                Product.objects.filter(pk=existing[barcode]).update(**product_fields(product))
+        for chunk in chunks(list(existing.values()), self.batch_size):
+            Position.objects.filter(product_id__in=chunk).delete()
+
+        category_ids = self.get_category_ids(
+            category
+            for product in products
+            for category in product['categories_hierarchy']
+            )
+        new_positions = []
+        for barcode, product in zip(barcodes, products):
+            new_positions.extend(self.build_positions(product_ids[barcode], product, category_ids))
+        Position.objects.bulk_create(new_positions, batch_size=self.batch_size)
+
+    def build_positions(self, product_id, product, category_ids):
+        return [
+            Position(product_id=product_id, category_id=category_ids[category], rank=i)
+            for i, category in enumerate(product['categories_hierarchy'][::-1])
+            ]
+
+    def insert_products(self, new_products):
+        """
+        Bulk insert [new_products] and return their ids, in the same order.
+        Some backends (SQLite) do not return ids from bulk inserts:
+        they are then read back, which is safe inside the transaction.
+        """
+        last = Product.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        created = Product.objects.bulk_create(new_products, batch_size=self.batch_size)
+        if all(product.pk is not None for product in created):
+            return [product.pk for product in created]
+        return list(Product.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True))
+
+    def get_category_ids(self, names):
+        """
+        Return a {category_name: id} map for [names],
+        creating the missing categories in bulk.
+        """
+        names = set(names)
+        category_ids = dict(Category.objects.values_list('category_name', 'pk'))
+        missing = names.difference(category_ids)
+        if missing:
+            Category.objects.bulk_create(
+                [Category(category_name=name) for name in missing],
+                batch_size=self.batch_size,
+                )
+            category_ids = dict(Category.objects.values_list('category_name', 'pk'))
+        return category_ids
+
+    def units(self):
+        return [
+            (category, grade, number)
+            for category in self.categories
+            for grade, number in self.grades
+            ]
+
+    def collect(self, checkpoint=None):
+        """
+        Fetch all the category & grade units, [workers] at a time.
+        With a [checkpoint], the products of each unit are saved as soon
+        as it is fetched, and the units fetched by a previous run are
+        loaded instead of being fetched again.
+        """
+        self.fetched = OrderedDict((unit, None) for unit in self.units())
+        if checkpoint is not None:
+            for unit in self.fetched:
+                self.fetched[unit] = checkpoint.load(unit)
+        missing = [unit for unit, products in self.fetched.items() if products is None]
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch_products, *unit): unit for unit in missing}
+            for future in as_completed(futures):
+                unit = futures[future]
+                try:
+                    self.fetched[unit] = future.result()
+                except Exception as error:
+                    print("Failed to fetch {}: {!r}".format(unit, error))
+                    errors.append(error)
+                    continue
+                if checkpoint is not None:
+                    checkpoint.save(unit, self.fetched[unit])
+        if errors:
+            raise errors[0]
+        for products in self.fetched.values():
+            self.add_products(products)
+            print("Products:", len(self.products))
+        print("{} duplicates merged.".format(self.duplicates))
+
+    def populate(self, checkpoint=None):
+        """
+        Fetch then register the products.
+        With a [checkpoint], each unit is registered with batched inserts
+        in its own transaction, whatever [bulk], and the units registered
+        by a previous run are skipped. Products
+        are registered with the first unit that fetched them, with their
+        merged categories hierarchy.
+        """
+        self.collect(checkpoint)
+        print("Registering products in database...")
+        if checkpoint is not None:
+            registered = set()
+            for unit, products in self.fetched.items():
+                barcodes = [
+                    barcode for barcode in OrderedDict.fromkeys(
+                        str(product['code']) for product in products)
+                    if barcode not in registered
+                    ]
+                registered.update(barcodes)
+                if checkpoint.is_registered(unit):
+                    continue
+                with transaction.atomic():
+                    self.insert_catalog([
+                        self.products[self.index[barcode]] for barcode in barcodes])
+                checkpoint.mark_registered(unit)
+        elif self.bulk:
+            self.register_bulk()
+        else:
+            self.register()
+        print("{} products registered in database.".format(len(self.products)))
+        self.catalog_updated()
+
+    def catalog_updated(self):
+        """
+        Rebuild the data derived from the catalog, once it changed.
+        """
+        print("Rebuilding catalog data...")
+        report = catalog.rebuild()
+        print("Catalog version {version}: {substitutes} substitutes, "
+            "{search_index} products indexed.".format(**report))
+
+    def refresh(self, checkpoint=None):
+        """
+        Incremental refresh: fetch the products, then apply the delta.
+        The delta is applied in one transaction: with a [checkpoint],
+        an interrupted run only has to fetch the missing units again.
+        """
+        self.collect(checkpoint)
+        print("Applying changes to database...")
+        counts = self.register_incremental()
+        print("{inserted} inserted, {updated} updated, {unchanged} unchanged, "
+            "{deleted} deleted.".format(**counts))
+        self.catalog_updated()
+        return counts
+
+    def register_incremental(self):
+        """
+        Upsert the fetched products by barcode, in one transaction:
+        - new barcodes are inserted in bulk,
+        - known barcodes only get their changed fields updated, and their
+          positions rewritten if their categories hierarchy changed,
+        - products which disappeared upstream are deleted, unless favorized.
+        Existing products keep their id. Return the counts of products
+        inserted, updated, unchanged and deleted.
+        """
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+        fetched = OrderedDict()
+        for product in self.products:
+            fetched.setdefault(str(product['code']), product)
+
+        with transaction.atomic():
+            existing = {}
+            duplicates = []
+            for row in Product.objects.order_by('pk').values(
+                    'pk', 'favorized', 'search_key', *PRODUCT_FIELDS):
+                if row['barcode'] in existing:
+                    duplicates.append(row)
+                else:
+                    existing[row['barcode']] = row
+            hierarchies = {}
+            for product_id, category_name in Position.objects.order_by(
+                    'product_id', 'rank').values_list('product_id', 'category__category_name'):
+                hierarchies.setdefault(product_id, []).append(category_name)
+
+            category_ids = self.get_category_ids(
+                category
+                for product in fetched.values()
+                for category in product['categories_hierarchy']
+                )
+            new_products = []
+            moved_ids = []
+            new_positions = []
+            for barcode, product in fetched.items():
+                row = existing.get(barcode)
+                if row is None:
+                    new_products.append(product)
+                    continue
+                fields = product_fields(product)
+                changed = {
+                    field: value for field, value in fields.items()
+                    if row[field] != value
+                    }
+                moved = hierarchies.get(row['pk'], []) != product['categories_hierarchy'][::-1]
+                if changed:
+                    Product.objects.filter(pk=row['pk']).update(**changed)
+                if moved:
+                    moved_ids.append(row['pk'])
+                    new_positions.extend(self.build_positions(row['pk'], product, category_ids))
+                if changed or moved:
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+
+            for chunk in chunks(moved_ids, self.batch_size):
+                Position.objects.filter(product_id__in=chunk).delete()
+            Position.objects.bulk_create(new_positions, batch_size=self.batch_size)
+
+            self.insert_catalog(new_products)
+            counts['inserted'] = len(new_products)
+
+            retired = [
+                row['pk'] for row in list(existing.values()) + duplicates
+                if row['favorized'] == 0 and (
+                    row['barcode'] not in fetched or row is not existing[row['barcode']])
+                ]
+            for chunk in chunks(retired, self.batch_size):
+                Product.objects.filter(pk__in=chunk).delete()
+            counts['deleted'] = len(retired)
+        return counts
+
+    def refresh_staged(self, checkpoint=None):
+        """
+        Zero-downtime refresh: fetch the products, load them in the staging
+        tables, then swap them into the catalog in one short transaction.
+        """
+        self.collect(checkpoint)
+        print("Loading staging tables...")
+        self.stage()
+        print("Swapping catalog...")
+        counts = self.swap()
+        print("{inserted} inserted, {updated} updated, {deleted} deleted.".format(**counts))
+        self.catalog_updated()
+        return counts
+
+    def stage(self):
+        """
+        Load the fetched products in the staging tables. The live tables
+        are not touched, so this can take as long as it needs.
+        """
+        StagedPosition.objects.all().delete()
+        StagedProduct.objects.all().delete()
+        staged = OrderedDict()
+        for product in self.products:
+            staged.setdefault(str(product['code']), product)
+        StagedProduct.objects.bulk_create(
+            [StagedProduct(**product_fields(product)) for product in staged.values()],
+            batch_size=self.batch_size,
+            )
+        StagedPosition.objects.bulk_create(
+            [
+                StagedPosition(barcode=barcode, category_name=category, rank=i)
+                for barcode, product in staged.items()
+                for i, category in enumerate(product['categories_hierarchy'][::-1])
+                ],
+            batch_size=self.batch_size,
+            )
+
+    def swap(self):
+        """
+        Replace the catalog with the staging tables, in one transaction
+        made of a few set-based statements:
+        products are matched by barcode, so the kept ones keep their id,
+        favorized products are never deleted and the users' favorites
+        links are left untouched. Only the products whose fields differ
+        from staging are updated, and only those whose positions differ
+        get them rewritten, so the writes follow the size of the changes,
+        not of the catalog. Readers see either the old catalog or the new
+        one. Return the counts of products inserted, updated and deleted.
+        """
+        tables = {
+            'product': Product._meta.db_table,
+            'category': Category._meta.db_table,
+            'position': Position._meta.db_table,
+            'staged_product': StagedProduct._meta.db_table,
+            'staged_position': StagedPosition._meta.db_table,
+            'rank': connection.ops.quote_name('rank'),
+            }
+        columns = list(PRODUCT_FIELDS) + ['search_key']
+        fields = ', '.join(columns)
+        assignments = ', '.join(
+            "{0} = (SELECT s.{0} FROM {staged_product} s "
+            "WHERE s.barcode = {product}.barcode)".format(field, **tables)
+            for field in columns if field != 'barcode'
+            )
+        differences = ' OR '.join(
+            "s.{0} <> p.{0} OR (s.{0} IS NULL) <> (p.{0} IS NULL)".format(field)
+            for field in columns if field != 'barcode'
+            )
+        with transaction.atomic(), connection.cursor() as cursor:
+            _, deleted = Product.objects.filter(favorized=0).exclude(
+                barcode__in=StagedProduct.objects.values('barcode')).delete()
+
+            cursor.execute("""
+                INSERT INTO {category} (category_name)
+                SELECT DISTINCT s.category_name FROM {staged_position} s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {category} c WHERE c.category_name = s.category_name)
+                """.format(**tables))
+            cursor.execute("""
+                SELECT p.barcode FROM {product} p
+                JOIN {staged_product} s ON s.barcode = p.barcode
+                WHERE {differences}
+                """.format(differences=differences, **tables))
+            changed = [row[0] for row in cursor.fetchall()]
+            for chunk in chunks(changed, self.batch_size):
+                cursor.execute("""
+                    UPDATE {product} SET {assignments} WHERE barcode IN ({barcodes})
+                    """.format(assignments=assignments,
+                        barcodes=', '.join(['%s'] * len(chunk)), **tables), chunk)
+            cursor.execute("""
+                SELECT s.barcode FROM {staged_product} s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {product} p WHERE p.barcode = s.barcode)
+                """.format(**tables))
+            new = {row[0] for row in cursor.fetchall()}
+            cursor.execute("""
+                INSERT INTO {product} ({fields}, favorized)
+                SELECT {fields}, 0 FROM {staged_product} s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {product} p WHERE p.barcode = s.barcode)
+                """.format(fields=fields, **tables))
+
+            # Products with a staged position they do not have (the new
+            # ones included), or with a position that is not staged.
+            cursor.execute("""
+                SELECT s.barcode FROM {staged_position} s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {position} po
+                    JOIN {product} p ON p.id = po.product_id
+                    JOIN {category} c ON c.id = po.category_id
+                    WHERE p.barcode = s.barcode AND c.category_name = s.category_name
+                        AND po.{rank} = s.{rank})
+                UNION
+                SELECT p.barcode FROM {position} po
+                JOIN {product} p ON p.id = po.product_id
+                JOIN {staged_product} sp ON sp.barcode = p.barcode
+                JOIN {category} c ON c.id = po.category_id
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {staged_position} s
+                    WHERE s.barcode = p.barcode AND s.category_name = c.category_name
+                        AND s.{rank} = po.{rank})
+                """.format(**tables))
+            moved = [row[0] for row in cursor.fetchall()]
+            for chunk in chunks(moved, self.batch_size):
+                barcodes = ', '.join(['%s'] * len(chunk))
+                cursor.execute("""
+                    DELETE FROM {position} WHERE product_id IN (
+                        SELECT id FROM {product} WHERE barcode IN ({barcodes}))
+                    """.format(barcodes=barcodes, **tables), chunk)
+                cursor.execute("""
+                    INSERT INTO {position} (product_id, category_id, {rank})
+                    SELECT p.id, c.id, s.{rank} FROM {staged_position} s
+                    JOIN {product} p ON p.barcode = s.barcode
+                    JOIN {category} c ON c.category_name = s.category_name
+                    WHERE s.barcode IN ({barcodes})
+                    """.format(barcodes=barcodes, **tables), chunk)
+
+        StagedPosition.objects.all().delete()
+        StagedProduct.objects.all().delete()
+        return {
+            'inserted': len(new),
+            'updated': len(set(changed).union(moved).difference(new)),
+            'deleted': deleted.get(Product._meta.label, 0),
+            }
+
+    def empty(self):
+        products_to_delete = Product.objects.filter(favorized=0)
+        products_to_delete_number = len(products_to_delete)
+        total_products = len(Product.objects.all())
+
+        products_to_delete.delete()
+        print("-\n{} deleted on a total of {}.-\n".format(
+                products_to_delete_number,
+                total_products,
+                )
+            )
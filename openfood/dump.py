@@ -0,0 +1,109 @@
+"""
+Readers for the Open Food Facts data exports:
+https://world.openfoodfacts.org/data
+Products are read one at a time, so the memory used does not depend
+on the size of the dump.
+"""
+import csv
+import gzip
+import io
+import json
+import re
+import unicodedata
+
+
+GRADE_KEYS = ('nutrition_grades', 'nutriscore_grade', 'nutrition_grade_fr')
+PRODUCT_URL = "https://fr.openfoodfacts.org/produit/{}"
+
+
+def open_dump(path):
+    """
+    Open the dump at [path] as text, gzip-compressed or not.
+    """
+    with open(path, 'rb') as dump:
+        compressed = dump.read(2) == b'\x1f\x8b'
+    if compressed:
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def guess_format(path):
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.csv') or name.endswith('.tsv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def iter_jsonl(lines):
+    """
+    Yield the products of a JSONL dump: one JSON product per line.
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_csv(lines):
+    """
+    Yield the products of a CSV dump (tab separated, as exported by OFF),
+    with the same keys as the search API.
+    """
+    csv.field_size_limit(2 ** 31 - 1)
+    for row in csv.DictReader(lines, delimiter='\t', quoting=csv.QUOTE_NONE):
+        product = dict(row)
+        product['categories_hierarchy'] = [
+            tag for tag in (row.get('categories_tags') or '').split(',') if tag
+            ]
+        yield product
+
+
+def iter_products(path, dump_format=None):
+    """
+    Yield the products of the dump at [path], in [dump_format]
+    ('jsonl' or 'csv', guessed from the file name by default).
+    """
+    dump_format = dump_format or guess_format(path)
+    readers = {'jsonl': iter_jsonl, 'csv': iter_csv}
+    with open_dump(path) as lines:
+        for product in readers[dump_format](lines):
+            yield product
+
+
+def normalize(product):
+    """
+    Return [product] with the keys registered by Collector, or None
+    if its name, barcode, grade or categories are missing.
+    """
+    grade = next((product[key] for key in GRADE_KEYS if product.get(key)), None)
+    if not (product.get('product_name') and product.get('code') and grade
+            and product.get('categories_hierarchy')):
+        return None
+    return {
+        'product_name': product['product_name'][:255],
+        'nutrition_grades': grade,
+        'url': (product.get('url') or PRODUCT_URL.format(product['code']))[:255],
+        'code': str(product['code'])[:50],
+        'brands': (product.get('brands') or '')[:255],
+        'stores': (product.get('stores') or '')[:255],
+        'categories_hierarchy': [tag[:255] for tag in product['categories_hierarchy']],
+        'image_url': (product.get('image_url') or '')[:255] or None,
+        }
+
+
+def slugify_tag(name):
+    """
+    Turn a category name into the tag used by OFF: "Salty snacks" -> "salty-snacks".
+    """
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return re.sub(r'[^a-z0-9]+', '-', name).strip('-')
+
+
+def tag_name(tag):
+    """
+    Drop the language prefix of a tag: "en:cheeses" -> "cheeses".
+    """
+    return tag.split(':', 1)[-1]
@@ -0,0 +1,126 @@
+"""
+Local stand-in for the Open Food Facts search API, serving synthetic
+products. Used by the benchmark command and the tests.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import hashlib
+import json
+import random
+import threading
+import time
+
+
+class FakeOffServer:
+    """
+    Serve [products_number] synthetic products for each category & grade
+    search on /cgi/search.pl, [latency] seconds after each request.
+    A share of [error_rate] requests fail with a 503 error.
+    A quarter of the products are returned under every category, as OFF
+    does for products with several categories.
+    [padding] characters of unused data are added to each product.
+    """
+
+    def __init__(self, products_number=100, latency=0, error_rate=0, padding=0, seed=0):
+        self.products_number = products_number
+        self.latency = latency
+        self.error_rate = error_rate
+        self.padding = padding
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/cgi/search.pl".format(self.server.server_address[1])
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, request):
+        with self.lock:
+            self.requests += 1
+            failing = self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failing:
+            request.send_error(503)
+            return
+        params = {key: values[0] for key, values in parse_qs(urlparse(request.path).query).items()}
+        body = json.dumps(self.search(params)).encode('utf-8')
+        try:
+            request.send_response(200)
+            request.send_header('Content-Type', 'application/json')
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        except ConnectionError:
+            # The client gave up waiting.
+            pass
+
+    def search(self, params):
+        page = int(params.get('page', 1))
+        page_size = int(params.get('page_size', 20))
+        first = (page - 1) * page_size
+        indexes = range(first, min(first + page_size, self.products_number))
+        return {
+            'count': self.products_number,
+            'page': page,
+            'page_size': page_size,
+            'skip': first,
+            'products': [self.product(params, i) for i in indexes],
+            }
+
+    def product(self, params, i):
+        """
+        Return the [i]th synthetic product matching the search [params].
+        """
+        category = params.get('tag_0') or params.get('search_terms', 'food')
+        grade = params.get('nutrition_grades', 'abcde'[i % 5])
+        shared = i % 4 == 0
+        key = "{}-{}".format(grade, i) if shared else "{}-{}-{}".format(category, grade, i)
+        code = str(int(hashlib.md5(key.encode('utf-8')).hexdigest()[:12], 16)).zfill(13)
+        tag = "en:" + category.lower().replace(' ', '-')
+        name = "Shared product {}".format(key) if shared else "{} {}".format(category, i)
+        product = {
+            'code': code,
+            'product_name': name,
+            'nutrition_grades': grade,
+            'url': "https://fr.openfoodfacts.org/produit/{}".format(code),
+            'brands': "Brand {}".format(i % 7),
+            'stores': "Store {}".format(i % 3),
+            'image_url': "https://static.openfoodfacts.org/images/{}.jpg".format(code),
+            'categories_hierarchy': ['en:foods', tag, "{}-{}".format(tag, i % 5)],
+            }
+        if self.padding:
+            product['ingredients_text'] = 'x' * self.padding
+        return product
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
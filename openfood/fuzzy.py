@@ -0,0 +1,133 @@
+"""
+Typo tolerant search of the catalog, for the queries the full-text
+search misses ("camenbert"), before falling back to Open Food Facts.
+Names are compared by their trigrams, the way pg_trgm does: on Postgres
+with a trigram GIN index on the product search keys (see migration
+0011), elsewhere by correcting each query word to the closest word of
+the product names, from an inverted index of their trigrams built with
+the catalog index (see index.py), then searching the corrected query.
+"""
+from array import array
+from collections import Counter
+from django.db import connection
+from openfood import search
+from openfood.models import Product
+from openfood.text import search_key
+
+import re
+
+WORD = re.compile(r'[^\W\d_]+')
+THRESHOLD = 0.3
+
+
+def trigrams(word):
+    """
+    Return the set of the trigrams of [word], padded like pg_trgm.
+    """
+    padded = '  ' + word + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Inverted index of the trigrams of [words]: the sorted words, and for
+    each trigram the array of the numbers of the words holding it.
+    """
+    def __init__(self, words):
+        self.words = sorted(words)
+        self.known = set(self.words)
+        self.sizes = array('l')
+        self.postings = {}
+        for number, word in enumerate(self.words):
+            word_trigrams = trigrams(word)
+            self.sizes.append(len(word_trigrams))
+            for trigram in word_trigrams:
+                self.postings.setdefault(trigram, array('l')).append(number)
+
+    @classmethod
+    def from_keys(cls, keys):
+        """
+        Build the index of the words of the search [keys], numbers aside.
+        """
+        return cls(set(WORD.findall(' '.join(keys))))
+
+    def similar(self, word, threshold=THRESHOLD):
+        """
+        Return the known word the most similar to [word], itself if it is
+        known, or None if none is at least [threshold] similar.
+        """
+        if word in self.known:
+            return word
+        query = trigrams(word)
+        shared = Counter()
+        for trigram in query:
+            shared.update(self.postings.get(trigram, ()))
+        def similarity(number):
+            return shared[number] / (len(query) + self.sizes[number] - shared[number])
+
+        best = max(shared, key=lambda number: (similarity(number), -number), default=None)
+        if best is None or similarity(best) < threshold:
+            return None
+        return self.words[best]
+
+    def correct(self, text):
+        """
+        Return [text] as a search key, its unknown words replaced by the
+        most similar known ones, or None if nothing was replaced.
+        """
+        words = search_key(text).split()
+        corrected = []
+        for word in words:
+            similar = self.similar(word) if WORD.fullmatch(word) else None
+            corrected.append(similar or word)
+        if corrected == words:
+            return None
+        return ' '.join(corrected)
+
+
+class FuzzySearch:
+    """
+    Query correction against the trigram index of the catalog index.
+    """
+    def search(self, text, limit=10):
+        from openfood.index import get_index
+        corrected = get_index().trigrams.correct(text)
+        if corrected is None:
+            return []
+        return search.get_backend().search(corrected, limit)
+
+
+class PostgresFuzzySearch(FuzzySearch):
+    """
+    pg_trgm word similarity between the query and the search keys, whose
+    threshold the trigram GIN index applies.
+    """
+    def search(self, text, limit=10):
+        key = search_key(text)
+        if not key:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT id FROM openfood_product WHERE %s <%% search_key
+                ORDER BY word_similarity(%s, search_key) DESC, length(search_key)
+                LIMIT %s
+                """, [key, key, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'postgresql': PostgresFuzzySearch,
+    }
+
+
+def get_backend():
+    return BACKENDS.get(connection.vendor, FuzzySearch)()
+
+
+def search_products(text, limit=10):
+    """
+    Return the [limit] products the most similar to [text], the closest first.
+    """
+    ids = get_backend().search(text, limit)
+    products = Product.objects.in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
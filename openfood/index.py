@@ -0,0 +1,109 @@
+"""
+Process-local index of the catalog: compact arrays of product ids by
+grade and of grade A or B product ids by category, so that the random
+products and live substitutes are picked without query, the sorted
+product search keys for the autocomplete, and the trigram index of their
+words for the fuzzy search. Each worker loads it once, and reloads it
+when the catalog version changes (see catalog.rebuild), under a lock so
+that only one thread builds it.
+"""
+from array import array
+from bisect import bisect_left
+from openfood.fuzzy import TrigramIndex
+from openfood.models import CatalogVersion, Position, Product
+from openfood.text import search_key
+
+import random
+import threading
+import time
+
+
+class CatalogIndex:
+    def __init__(self, version):
+        self.version = version
+        self.grades = {}
+        self.categories = {}
+        self.keys = []
+        self.names = []
+        self.trigrams = TrigramIndex(())
+        self.checked = time.monotonic()
+
+    @classmethod
+    def load(cls, version):
+        """
+        Build the index of the catalog [version], with two queries.
+        """
+        index = cls(version)
+        names = []
+        for product_id, grade, name, key in Product.objects.order_by('pk').values_list(
+                'pk', 'grade', 'product_name', 'search_key').iterator():
+            index.grades.setdefault(grade, array('l')).append(product_id)
+            names.append((key, name, grade))
+        names.sort()
+        index.keys = [key for key, name, grade in names]
+        index.names = [(name, grade) for key, name, grade in names]
+        index.trigrams = TrigramIndex.from_keys(index.keys)
+        for category_id, product_id in Position.objects.filter(
+                product__grade__in=['a', 'b']).order_by(
+                'category_id', 'product_id').values_list(
+                'category_id', 'product_id').iterator():
+            index.categories.setdefault(category_id, array('l')).append(product_id)
+        return index
+
+    def random_product(self, grade):
+        """
+        Return the id of a product of [grade] at random, or None.
+        """
+        ids = self.grades.get(grade)
+        return random.choice(ids) if ids else None
+
+    def random_ab(self, category_id, number, exclude=()):
+        """
+        Return the ids of [number] grade A or B products of the category
+        [category_id], at random and other than the [exclude] ids.
+        """
+        ids = self.categories.get(category_id, ())
+        if len(ids) <= number + len(exclude):
+            ids = [product_id for product_id in ids if product_id not in exclude]
+            return random.sample(ids, min(number, len(ids)))
+        picks = random.sample(range(len(ids)), number + len(exclude))
+        return [ids[pick] for pick in picks if ids[pick] not in exclude][:number]
+
+    def autocomplete(self, prefix, grades='abcde', number=10):
+        """
+        Return the [number] first product names, in search key order,
+        starting with [prefix] whatever their accents and case, of [grades].
+        """
+        prefix = search_key(prefix)
+        names = []
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(names) < number and self.keys[i].startswith(prefix):
+            name, grade = self.names[i]
+            if grade in grades:
+                names.append(name)
+            i += 1
+        return names
+
+
+index = None
+index_lock = threading.Lock()
+
+
+def get_index(max_age=0):
+    """
+    Return the index of the current catalog version, loaded on the first
+    call and after each bump, at the cost of one query otherwise.
+    The version is not checked again within [max_age] seconds.
+    """
+    global index
+    current = index
+    if current is not None and time.monotonic() - current.checked < max_age:
+        return current
+    version = CatalogVersion.objects.get_version()
+    if current is not None and current.version == version:
+        current.checked = time.monotonic()
+        return current
+    with index_lock:
+        if index is None or index.version != version:
+            index = CatalogIndex.load(version)
+    return index
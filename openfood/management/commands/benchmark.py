@@ -0,0 +1,296 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from openfood import search
+from openfood.collector import Collector
+from openfood.fake_off import FakeOffServer
+from openfood.index import CatalogIndex
+from django.db.models import Q
+from openfood.models import Product, Category, Position
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import io
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+
+class Benchmark:
+    """
+    Run the ingestion pipeline against a local fake Open Food Facts server
+    and measure, for each scenario: wall time, database queries, HTTP
+    requests, peak Python memory and products registered per second.
+    The scenarios run in order on the current database.
+    Memory is traced with tracemalloc, which slows the runs down: only
+    compare results obtained with the same options.
+    """
+    scenarios = ['initialize', 'refresh', 'refresh-incremental', 'refresh-staged']
+
+    def __init__(self, server, categories=10, number_by_grade=150, workers=8):
+        self.server = server
+        self.categories = ["Category {}".format(i) for i in range(categories)]
+        self.number_by_grade = number_by_grade
+        self.workers = workers
+        self.results = []
+
+    def collector(self):
+        return Collector(
+            url=self.server.url,
+            number_by_grade=[(grade, self.number_by_grade) for grade in 'abcde'],
+            categories=self.categories,
+            workers=self.workers,
+            )
+
+    def run(self, scenarios=None):
+        for scenario in scenarios or self.scenarios:
+            method = getattr(self, 'bench_' + scenario.replace('-', '_'))
+            self.results.append(self.measure(scenario, method))
+        return self.results
+
+    def measure(self, scenario, method):
+        requests_before = self.server.requests
+        tracemalloc.start()
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries, redirect_stdout(io.StringIO()):
+            products = method()
+        wall_time = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {
+            'scenario': scenario,
+            'wall_time': round(wall_time, 4),
+            'queries': len(queries),
+            'http_requests': self.server.requests - requests_before,
+            'peak_memory': peak_memory,
+            'products': products,
+            'products_per_second': round(products / wall_time, 1) if wall_time else None,
+            }
+
+    def bench_initialize(self):
+        collector = self.collector()
+        collector.populate()
+        return len(collector.products)
+
+    def bench_refresh(self):
+        collector = self.collector()
+        collector.empty()
+        collector.populate()
+        return len(collector.products)
+
+    def bench_refresh_incremental(self):
+        collector = self.collector()
+        collector.refresh()
+        return len(collector.products)
+
+    def bench_refresh_staged(self):
+        collector = self.collector()
+        collector.refresh_staged()
+        return len(collector.products)
+
+
+class SamplingBenchmark:
+    """
+    Measure the latency of picking random products from catalogs of
+    growing [sizes]: with the catalog index against ORDER BY RANDOM().
+    Latencies are averaged over [samples] picks.
+    The synthetic products are added to the current database.
+    """
+    sizes = [1000, 10000, 100000, 1000000]
+
+    def __init__(self, sizes=None, samples=20, categories=10, batch_size=5000):
+        self.sizes = sizes or self.sizes
+        self.samples = samples
+        self.categories = categories
+        self.batch_size = batch_size
+        self.results = []
+
+    def run(self):
+        Category.objects.bulk_create([
+            Category(category_name="Sampling {}".format(i)) for i in range(self.categories)])
+        categories = list(Category.objects.filter(category_name__startswith="Sampling "))
+        for size in sorted(self.sizes):
+            self.grow(size, categories)
+            self.results.append(self.measure(size, categories))
+        return self.results
+
+    def measure(self, size, categories):
+        index = CatalogIndex.load(version=None)
+        category = categories[0]
+        return {
+            'products': size,
+            'random_product_index': self.latency(
+                lambda: Product.objects.get(pk=index.random_product('e'))),
+            'random_product_order_by': self.latency(
+                lambda: Product.objects.filter(grade='e').order_by('?').first()),
+            'random_ab_products_index': self.latency(
+                lambda: list(Product.objects.in_bulk(index.random_ab(category.pk, 6)))),
+            'random_ab_products_order_by': self.latency(
+                lambda: list(category.products.filter(
+                    grade__in=['a', 'b']).order_by('?')[:6])),
+            }
+
+    def grow(self, size, categories):
+        """
+        Add synthetic products until the catalog holds [size] of them.
+        """
+        count = Product.objects.count()
+        while count < size:
+            last = Product.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            number = min(self.batch_size, size - count)
+            Product.objects.bulk_create([
+                Product(
+                    product_name="Sampling product {}".format(count + i),
+                    search_key="sampling product {}".format(count + i),
+                    grade='abcde'[(count + i) % 5],
+                    url="", barcode=str(count + i), brand="", store="",
+                    )
+                for i in range(number)
+                ])
+            Position.objects.bulk_create([
+                Position(product_id=product_id,
+                    category=categories[product_id // 5 % len(categories)], rank=0)
+                for product_id in Product.objects.filter(pk__gt=last).values_list(
+                    'pk', flat=True)
+                ])
+            count += number
+
+    def latency(self, pick):
+        start = time.perf_counter()
+        for i in range(self.samples):
+            pick()
+        return round((time.perf_counter() - start) / self.samples, 6)
+
+
+class AutocompleteBenchmark(SamplingBenchmark):
+    """
+    Measure the latency of the autocomplete on catalogs of growing
+    [sizes], for [prefixes] matching many, few or no products: with the
+    catalog index against the product_name__istartswith query.
+    """
+    prefixes = ['s', 'sampling product 12', 'sampling product 99999', 'z']
+
+    def measure(self, size, categories):
+        index = CatalogIndex.load(version=None)
+        result = {'products': size}
+        for prefix in self.prefixes:
+            result['index:' + prefix] = self.latency(
+                lambda: index.autocomplete(prefix, grades='bcde'))
+            result['query:' + prefix] = self.latency(lambda: [
+                product.product_name for product in Product.objects.filter(
+                    Q(product_name__istartswith=prefix) &
+                    (Q(grade='e') | Q(grade='d') | Q(grade='c') | Q(grade='b'))
+                    ).order_by('product_name')[:10]
+                ])
+        return result
+
+
+class SearchBenchmark(SamplingBenchmark):
+    """
+    Measure the latency of the product search on catalogs of growing
+    [sizes], for [queries] matching every, few or no products: with the
+    full-text index against the product_name__icontains query.
+    """
+    queries = ['sampling', 'product 1234', 'zzz']
+
+    def measure(self, size, categories):
+        search.rebuild()
+        result = {'products': size}
+        for query in self.queries:
+            result['index:' + query] = self.latency(
+                lambda: search.search_products(query, 1))
+            result['query:' + query] = self.latency(
+                lambda: Product.objects.filter(product_name__icontains=query).first())
+        return result
+
+
+class Command(BaseCommand):
+    """
+    Django command to benchmark the ingestion pipeline on a throwaway
+    test database, against a local fake Open Food Facts server.
+    Results are written to a JSON file.
+    """
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', choices=['ingestion', 'sampling', 'autocomplete', 'search'],
+            default='ingestion',
+            help="Benchmark the ingestion pipeline, the random product sampling, "
+            "the autocomplete or the search.")
+        parser.add_argument('--size', type=int, action='append', dest='sizes',
+            help="Other suites than ingestion: catalog size to measure (repeatable), "
+            "1k to 1M by default.")
+        parser.add_argument('--samples', type=int, default=20,
+            help="Other suites than ingestion: number of calls averaged for each measure.")
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+            choices=Benchmark.scenarios,
+            help="Scenario to run (repeatable), all of them by default.")
+        parser.add_argument('--products', type=int, default=200,
+            help="Number of products served for each category & grade.")
+        parser.add_argument('--number-by-grade', type=int, default=150,
+            help="Number of products fetched for each category & grade.")
+        parser.add_argument('--categories', type=int, default=10,
+            help="Number of categories fetched.")
+        parser.add_argument('--latency', type=float, default=0.05,
+            help="Latency of the fake server, in seconds.")
+        parser.add_argument('--padding', type=int, default=2000,
+            help="Size of the unused data added to each product.")
+        parser.add_argument('--workers', type=int, default=8,
+            help="Number of concurrent requests.")
+        parser.add_argument('--output',
+            default=os.path.join(settings.BASE_DIR, 'refresh_logs', 'benchmark-{}.json'.format(
+                datetime.strftime(datetime.now(), "%d-%m-%Y@%H-%M-%S"))),
+            help="Path of the JSON results file.")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            if options['suite'] == 'sampling':
+                results = SamplingBenchmark(options['sizes'], options['samples']).run()
+            elif options['suite'] == 'autocomplete':
+                results = AutocompleteBenchmark(options['sizes'], options['samples']).run()
+            elif options['suite'] == 'search':
+                results = SearchBenchmark(options['sizes'], options['samples']).run()
+            else:
+                results = self.run_ingestion(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'suite': options['suite'],
+            'options': {
+                key: options[key] for key in (
+                    'products', 'number_by_grade', 'categories', 'latency',
+                    'padding', 'workers', 'sizes', 'samples')
+                },
+            'results': results,
+            }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+
+        for result in results:
+            if options['suite'] != 'ingestion':
+                self.stdout.write("{} products: {}".format(result['products'], ", ".join(
+                    "{} {}s".format(key, value) for key, value in result.items()
+                    if key != 'products')))
+            else:
+                self.stdout.write(
+                    "{scenario}: {wall_time}s, {queries} queries, {http_requests} requests, "
+                    "{peak_memory} bytes peak, {products_per_second} products/s".format(**result))
+        self.stdout.write("Results written to {}.".format(options['output']))
+
+    def run_ingestion(self, options):
+        with FakeOffServer(products_number=options['products'],
+                latency=options['latency'], padding=options['padding']) as server:
+            benchmark = Benchmark(
+                server,
+                categories=options['categories'],
+                number_by_grade=options['number_by_grade'],
+                workers=options['workers'],
+                )
+            return benchmark.run(options['scenarios'])
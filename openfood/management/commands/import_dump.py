@@ -0,0 +1,122 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from openfood.collector import Collector
+from openfood.dump import iter_products, normalize, slugify_tag, tag_name
+from openfood.models import Product
+
+# OFF tags of the Collector's default categories whose name is not one.
+CATEGORY_TAGS = {
+    "Beverage": "beverages",
+    "chocolats": "chocolates",
+    "Snacks sucrés": "sweet-snacks",
+    }
+
+
+class DumpImporter:
+    """
+    Register products from an Open Food Facts dump file, with the same
+    selection rules as Collector: the collector's number of products by
+    grade (None for all of them) for each one of its categories.
+    Products are inserted [batch_size] at a time, so only one batch
+    is held in memory.
+    """
+
+    def __init__(self, collector, batch_size=1000):
+        self.collector = collector
+        self.batch_size = batch_size
+        self.tags = [
+            (category, CATEGORY_TAGS.get(category) or slugify_tag(tag_name(category)))
+            for category in collector.categories
+            ]
+        self.quotas = {
+            (category, grade): number
+            for category in collector.categories
+            for grade, number in collector.grades
+            }
+        self.barcodes = set(Product.objects.values_list('barcode', flat=True))
+        self.matched = set()
+        self.read = 0
+        self.registered = 0
+
+    def select(self, product):
+        """
+        Return the (category, grade) unit [product] is registered for,
+        or None if it is not wanted.
+        """
+        tags = set(tag_name(tag) for tag in product['categories_hierarchy'])
+        for category, tag in self.tags:
+            unit = (category, product['nutrition_grades'])
+            if tag in tags and unit in self.quotas:
+                return unit
+        return None
+
+    def run(self, path, dump_format=None):
+        batch = []
+        for product in iter_products(path, dump_format):
+            self.read += 1
+            product = normalize(product)
+            if product is None or product['code'] in self.barcodes:
+                continue
+            unit = self.select(product)
+            if unit is None:
+                continue
+            self.matched.add(unit[0])
+            if self.quotas[unit] is not None:
+                self.quotas[unit] -= 1
+                if self.quotas[unit] == 0:
+                    del self.quotas[unit]
+            self.barcodes.add(product['code'])
+            batch.append(product)
+            if len(batch) == self.batch_size:
+                self.register(batch)
+                batch = []
+            if not self.quotas:
+                break
+        self.register(batch)
+        unmatched = [tag for category, tag in self.tags if category not in self.matched]
+        if unmatched:
+            print("No product of the dump under the tags {}: check the categories.".format(
+                ", ".join(unmatched)))
+        self.collector.catalog_updated()
+
+    def register(self, batch):
+        with transaction.atomic():
+            self.collector.insert_catalog(batch)
+        self.registered += len(batch)
+        print("{} products read, {} registered.".format(self.read, self.registered))
+
+
+class Command(BaseCommand):
+    """
+    Django command to import data from a local Open Food Facts dump,
+    JSONL or CSV, gzip-compressed or not.
+    """
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Path to the dump file.")
+        parser.add_argument('--format', choices=('jsonl', 'csv'), dest='dump_format',
+            help="Dump format, guessed from the file name by default.")
+        parser.add_argument('--number-by-grade', type=int, default=150,
+            help="Products to register by category and grade, 0 for all of them.")
+        parser.add_argument('--category', action='append', dest='categories',
+            help="Category to import (repeatable), Collector's categories by default.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of products inserted at a time.")
+        parser.add_argument('--empty', action='store_true',
+            help="Delete the products which are not favorized first.")
+
+    def handle(self, *args, **options):
+        number = options['number_by_grade']
+        kwargs = {
+            'number_by_grade': [(grade, number or None) for grade in 'abcde'],
+            }
+        if options['categories']:
+            kwargs['categories'] = options['categories']
+        collector = Collector(**kwargs)
+        if options['empty']:
+            collector.empty()
+
+        importer = DumpImporter(collector, batch_size=options['batch_size'])
+        try:
+            importer.run(options['path'], options['dump_format'])
+        except (OSError, ValueError) as error:
+            raise CommandError("Can't import {}: {}".format(options['path'], error))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+from openfood import catalog
+
+
+class Command(BaseCommand):
+    """
+    Django command to rebuild the data derived from the catalog:
+    substitutes and search index, then bump the catalog version.
+    The collector commands do it after each update.
+    """
+    def handle(self, *args, **options):
+        report = catalog.rebuild()
+        for name, value in sorted(report.items()):
+            self.stdout.write("{}: {}".format(name, value))
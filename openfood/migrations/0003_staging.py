@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 09:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openfood', '0002_product_favorized'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedPosition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('barcode', models.CharField(db_index=True, max_length=50)),
+                ('category_name', models.CharField(db_index=True, max_length=255)),
+                ('rank', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StagedProduct',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=255)),
+                ('grade', models.CharField(max_length=1)),
+                ('url', models.CharField(max_length=255)),
+                ('barcode', models.CharField(db_index=True, max_length=50)),
+                ('brand', models.CharField(max_length=255)),
+                ('store', models.CharField(max_length=255)),
+                ('product_img_url', models.CharField(max_length=255, null=True)),
+            ],
+        ),
+    ]
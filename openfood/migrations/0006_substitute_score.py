@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 09:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openfood', '0005_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='substitute',
+            name='score',
+            field=models.FloatField(default=0),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 09:22
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Merge the products sharing a barcode, and the categories sharing a
+    name, into the oldest one, before they are made unique.
+    The positions and favorites of the duplicates are moved to it.
+    """
+    Category = apps.get_model('openfood', 'Category')
+    Product = apps.get_model('openfood', 'Product')
+    Position = apps.get_model('openfood', 'Position')
+    Favorite = apps.get_model('openuser', 'Profile').products.through
+
+    duplicated = Category.objects.values('category_name').annotate(
+        count=Count('pk')).filter(count__gt=1).values_list('category_name', flat=True)
+    for name in duplicated:
+        kept, *duplicates = Category.objects.filter(category_name=name).order_by('pk')
+        for position in Position.objects.filter(category__in=duplicates):
+            if Position.objects.filter(product_id=position.product_id, category=kept).exists():
+                position.delete()
+            else:
+                position.category = kept
+                position.save()
+        Category.objects.filter(pk__in=[category.pk for category in duplicates]).delete()
+
+    duplicated = Product.objects.values('barcode').annotate(
+        count=Count('pk')).filter(count__gt=1).values_list('barcode', flat=True)
+    for barcode in duplicated:
+        kept, *duplicates = Product.objects.filter(barcode=barcode).order_by('pk')
+        categories = set(Position.objects.filter(product=kept).values_list(
+            'category_id', flat=True))
+        for position in Position.objects.filter(product__in=duplicates).order_by('rank'):
+            if position.category_id not in categories:
+                categories.add(position.category_id)
+                position.product = kept
+                position.save()
+        profiles = set(Favorite.objects.filter(product=kept).values_list(
+            'profile_id', flat=True))
+        for favorite in Favorite.objects.filter(product__in=duplicates):
+            if favorite.profile_id not in profiles:
+                profiles.add(favorite.profile_id)
+                Favorite.objects.create(profile_id=favorite.profile_id, product=kept)
+        kept.favorized = len(profiles)
+        kept.save()
+        Product.objects.filter(pk__in=[product.pk for product in duplicates]).delete()
+
+
+class Migration(migrations.Migration):
+    """
+    Kept apart from 0008, which makes the merged columns unique: on
+    PostgreSQL the deletions queue deferred foreign key checks, which
+    must be committed before the tables can be altered.
+    """
+
+    dependencies = [
+        ('openfood', '0006_substitute_score'),
+        ('openuser', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
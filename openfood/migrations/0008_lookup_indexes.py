@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 09:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openfood', '0007_merge_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='category_name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='barcode',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['category', 'product', 'rank'], name='openfood_po_categor_5b8f5a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['grade', 'product_name'], name='openfood_pr_grade_81f400_idx'),
+        ),
+    ]
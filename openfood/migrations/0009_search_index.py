@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create the full-text search table of the database, see search.py.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("""
+            CREATE VIRTUAL TABLE openfood_product_fts USING fts5(
+                product_name, brand, categories,
+                tokenize='unicode61 remove_diacritics 1')
+            """)
+    elif vendor == 'postgresql':
+        schema_editor.execute("""
+            CREATE TABLE openfood_product_search (
+                product_id integer PRIMARY KEY
+                    REFERENCES openfood_product (id) ON DELETE CASCADE
+                    DEFERRABLE INITIALLY DEFERRED,
+                document tsvector NOT NULL)
+            """)
+        schema_editor.execute("""
+            CREATE INDEX openfood_product_search_document
+            ON openfood_product_search USING GIN (document)
+            """)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE openfood_product_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP TABLE openfood_product_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openfood', '0008_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
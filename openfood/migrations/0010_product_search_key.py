@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 09:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from openfood.text import search_key
+
+
+def fill_search_keys(apps, schema_editor):
+    """
+    Compute the search keys of the existing products, one update by
+    distinct name.
+    """
+    Product = apps.get_model('openfood', 'Product')
+    names = Product.objects.order_by().values_list('product_name', flat=True).distinct()
+    for name in list(names.iterator()):
+        Product.objects.filter(product_name=name).update(search_key=search_key(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openfood', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_key',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='stagedproduct',
+            name='search_key',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+    ]
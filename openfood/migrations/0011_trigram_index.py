@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    Create the pg_trgm index of the product search keys, see fuzzy.py.
+    Other databases use an index built in memory.
+    """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute("""
+            CREATE INDEX openfood_product_search_key_trgm
+            ON openfood_product USING GIN (search_key gin_trgm_ops)
+            """)
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX openfood_product_search_key_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openfood', '0010_product_search_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -1,39 +1,112 @@
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
 from django.shortcuts import get_object_or_404 # TODO Can I use it in Model Manager ?
+from openfood.ranking import SimilarityIndex
+from openfood import text
+
+import random
 
 class ProductManager(models.Manager):
-    def get_substitutes(self, pk):
+    def get_substitutes(self, pk, number=6, exclude=()):
+        """
+        Return the product [pk] and its [number] best precomputed
+        substitutes, ties picked at random, other than the [exclude] ids.
+        Products without precomputed substitutes are looked up live, and
+        so are the places left by the [exclude] ids (see top_up).
+        """
         context = {}
-        # context['product'] = Product.objects.get(pk=pk)
         context['product'] = get_object_or_404(Product, pk=pk)
-        # product = Product.objects.get(pk=pk)
-        product = get_object_or_404(Product, pk=pk)
-        categories = product.categories.all()
-        positions = Position.objects.filter(product=context['product'])
-        categories_and_rank = []
-
-        for category in categories:
-            categories_and_rank.append(
-                (category.category_name, category.position_set.get(
-                    category=category, product=product))
-                )
-
-        for category, rank in categories_and_rank:
-            substitutes = Category.objects.filter(
-                category_name=category).first().products.all().filter(
-                Q(grade="a") | Q(grade="b")).order_by('?')[:6]
-            if substitutes.count() != 0:
-                context['substitutes'] = substitutes
-                break
-
-        if substitutes.count() == 0:
-            context['substitutes'] = None # TODO The template should returns Error...
+        rows = list(Substitute.objects.filter(product_id=pk).select_related('substitute'))
+        kept = [row for row in rows if row.substitute_id not in exclude]
+        if kept:
+            kept.sort(key=lambda substitute: (-substitute.score, random.random()))
+            context['substitutes'] = [substitute.substitute for substitute in kept[:number]]
+            if len(kept) < len(rows):
+                context['substitutes'] = self.top_up(
+                    context['product'], context['substitutes'], number, exclude)
+        else:
+            context['substitutes'] = self.ab_substitutes(context['product'], number, exclude)
+        return context
+
+    def top_up(self, product, substitutes, number, exclude=()):
+        """
+        Return the [substitutes] of [product] completed up to [number]
+        with live ones (see ab_substitutes), other than the [exclude] ids.
+        """
+        missing = number - len(substitutes)
+        if missing <= 0:
+            return substitutes
+        extra = self.ab_substitutes(
+            product, missing, set(exclude) | {substitute.pk for substitute in substitutes})
+        return substitutes + (extra or [])
+
+    def batch_substitutes(self, product_ids, number=6):
+        """
+        Return {product id: its [number] best precomputed substitutes} for
+        all of [product_ids], in a single query.
+        Products without precomputed substitutes are looked up live, like
+        ab_substitutes does, together in at most three more queries.
+        """
+        substitutes = {product_id: [] for product_id in product_ids}
+        for substitute in Substitute.objects.filter(
+                product_id__in=product_ids).select_related('substitute').order_by(
+                'product_id', '-score'):
+            if len(substitutes[substitute.product_id]) < number:
+                substitutes[substitute.product_id].append(substitute.substitute)
+        missing = [product_id for product_id, found in substitutes.items() if not found]
+        if missing:
+            self.batch_ab_substitutes(missing, number, substitutes)
+        return substitutes
 
+    def batch_ab_substitutes(self, product_ids, number, substitutes):
+        """
+        Fill [substitutes] with [number] live substitutes of each of
+        [product_ids] (see ab_substitutes), picked in the catalog index,
+        from the positions of all of them and then fetched in one query.
+        """
+        from openfood.index import get_index
+        index = get_index()
+        picks = {}
+        for product_id, category_id in Position.objects.filter(
+                product_id__in=product_ids).order_by(
+                'product_id', 'rank').values_list('product_id', 'category_id'):
+            if not picks.get(product_id):
+                picks[product_id] = index.random_ab(category_id, number, {product_id})
+        products = self.in_bulk({pk for ids in picks.values() for pk in ids})
+        for product_id, ids in picks.items():
+            substitutes[product_id] = [products[pk] for pk in ids if pk in products]
+
+    def find_substitutes(self, pk, number=6, exclude=()):
+        """
+        Return the product [pk] and [number] of its substitutes, other
+        than the [exclude] ids, looked up live (see ab_substitutes).
+        """
+        context = {}
+        context['product'] = get_object_or_404(Product, pk=pk)
+        context['substitutes'] = self.ab_substitutes(context['product'], number, exclude)
         return context
 
+    def ab_substitutes(self, product, number=6, exclude=()):
+        """
+        Return [number] grade A or B products, at random, from the most
+        specific category of [product] (lowest 'rank') holding any other
+        than the [exclude] ids, or None.
+        The categories are checked and the products picked in the catalog
+        index (see index.CatalogIndex), then fetched in one query.
+        """
+        from openfood.index import get_index
+        index = get_index()
+        exclude = set(exclude) | {product.pk}
+        for category_id in Position.objects.filter(product=product).order_by(
+                'rank').values_list('category_id', flat=True):
+            ids = index.random_ab(category_id, number, exclude)
+            if ids:
+                products = self.in_bulk(ids)
+                return [products[product_id] for product_id in ids if product_id in products]
+        return None # TODO The template should returns Error...
+
+
 class Category(models.Model):
-    category_name = models.CharField(max_length=255)
+    category_name = models.CharField(max_length=255, unique=True)
 
     def __str__(self):
         return self.category_name
@@ -46,19 +119,27 @@ class Product(models.Model):
     product_name = models.CharField(max_length=255)
     grade = models.CharField(max_length=1)
     url = models.CharField(max_length=255)
-    barcode = models.CharField(max_length=50)
+    barcode = models.CharField(max_length=50, unique=True)
     brand = models.CharField(max_length=255)
     store = models.CharField(max_length=255)
     categories = models.ManyToManyField(Category, related_name='products', through='Position')
     product_img_url = models.CharField(max_length=255, null=True)
     favorized = models.IntegerField(default=0)
+    search_key = models.CharField(max_length=255, db_index=True, default='')
     objects = ProductManager()
 
     def __str__(self):
         return self.product_name
 
+    def save(self, *args, **kwargs):
+        self.search_key = text.search_key(self.product_name)
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name_plural = "Produits"
+        indexes = [
+            models.Index(fields=['grade', 'product_name']),
+        ]
 
 
 class Position(models.Model):
@@ -67,4 +148,93 @@ class Position(models.Model):
     rank = models.IntegerField()
 
     def __str__(self):
-        return str(self.rank)
\ No newline at end of file
+        return str(self.rank)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', 'product', 'rank']),
+        ]
+
+class SubstituteManager(models.Manager):
+    def rebuild(self, limit=12, batch_size=500):
+        """
+        Precompute the [limit] best grade A or B substitutes of every
+        product, ranked by category similarity (see ranking.SimilarityIndex).
+        """
+        index = SimilarityIndex(
+            Position.objects.values_list('product_id', 'category_id', 'rank').iterator(),
+            Product.objects.filter(grade__in=['a', 'b']).values_list('pk', flat=True),
+            )
+        substitutes = [
+            Substitute(product_id=product_id, substitute_id=candidate, score=score, level=level)
+            for product_id, best in index.rank_all(limit)
+            for candidate, score, level in best
+            ]
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(substitutes, batch_size=batch_size)
+        return len(substitutes)
+
+
+class Substitute(models.Model):
+    """
+    Precomputed substitutes of each product, see SubstituteManager.rebuild.
+    'level' is the rank of their most specific shared category.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='substitute_set')
+    substitute = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField(default=0)
+    level = models.IntegerField()
+    objects = SubstituteManager()
+
+
+class CatalogVersionManager(models.Manager):
+    def get_version(self):
+        version = self.values_list('version', flat=True).first()
+        return version or 0
+
+    def bump(self):
+        """
+        Give a new version number to the catalog, after it changed.
+        """
+        with transaction.atomic():
+            catalog, created = self.select_for_update().get_or_create(pk=1)
+            catalog.version += 1
+            catalog.save()
+        return catalog.version
+
+
+class CatalogVersion(models.Model):
+    """
+    Version of the catalog, bumped by the collector after each update.
+    Data derived from the catalog and cached outside of the database
+    is keyed by this number.
+    """
+    version = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+    objects = CatalogVersionManager()
+
+
+class StagedProduct(models.Model):
+    """
+    Staging copy of the catalog, loaded by the refresh before it is
+    swapped into 'Product' (see Collector.swap).
+    """
+    product_name = models.CharField(max_length=255)
+    grade = models.CharField(max_length=1)
+    url = models.CharField(max_length=255)
+    barcode = models.CharField(max_length=50, db_index=True)
+    brand = models.CharField(max_length=255)
+    store = models.CharField(max_length=255)
+    product_img_url = models.CharField(max_length=255, null=True)
+    search_key = models.CharField(max_length=255, default='')
+
+
+class StagedPosition(models.Model):
+    """
+    Staging copy of 'Position', with the barcode and category name
+    instead of the foreign keys.
+    """
+    barcode = models.CharField(max_length=50, db_index=True)
+    category_name = models.CharField(max_length=255, db_index=True)
+    rank = models.IntegerField()
@@ -0,0 +1,450 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+from urllib3.util.retry import Retry
+
+import codecs
+import hashlib
+import json
+import os
+import requests
+import threading
+import time
+
+
+SEARCH_URL = "https://fr.openfoodfacts.org/cgi/search.pl"
+CHUNK_SIZE = 16384
+WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(chunks, key):
+    """
+    Yield the items of the array stored under [key] in the JSON object
+    read from [chunks] (bytes), decoding each item as soon as it is
+    complete. The other members of the object are skipped.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            chunk = b''
+        buffer = buffer[position:] + utf8.decode(chunk, final=eof)
+        position = 0
+
+    def next_char():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                raise ValueError("Unexpected end of JSON document.")
+            read_more()
+
+    def expect(characters):
+        nonlocal position
+        char = next_char()
+        if char not in characters:
+            raise ValueError("Expected one of {!r}, got {!r}.".format(characters, char))
+        position += 1
+        return char
+
+    def next_value():
+        nonlocal position
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+                read_more()
+                continue
+            # A number cut at the end of the buffer may go on in the next chunk.
+            if end == len(buffer) and not eof:
+                read_more()
+                continue
+            position = end
+            return value
+
+    expect('{')
+    if next_char() == '}':
+        return
+    while True:
+        member = next_value()
+        expect(':')
+        if member == key:
+            expect('[')
+            if next_char() == ']':
+                position += 1
+            else:
+                while True:
+                    yield next_value()
+                    if expect(',]') == ']':
+                        break
+        else:
+            next_value()
+        if expect(',}') == '}':
+            return
+
+
+class ResponseCache:
+    """
+    On-disk cache of Open Food Facts responses, one file per query.
+    Entries are keyed by the url and the sorted query parameters,
+    are fresh for [ttl] seconds, then revalidated with their ETag or
+    Last-Modified date if the server sent one. When the cache grows
+    over [max_size] bytes, the least recently used entries are deleted.
+    """
+
+    def __init__(self, directory, ttl=3600, max_size=100 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Build the cache described by the OFF_CACHE setting.
+        """
+        options = getattr(settings, 'OFF_CACHE', {})
+        return cls(
+            options.get('DIR', os.path.join(settings.BASE_DIR, 'off_cache')),
+            ttl=options.get('TTL', 3600),
+            max_size=options.get('MAX_SIZE', 100 * 1024 * 1024),
+            )
+
+    def path(self, url, params):
+        query = urlencode(sorted((str(key), str(value)) for key, value in params.items()))
+        key = hashlib.sha1("{}?{}".format(url, query).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.cache')
+
+    def get(self, url, params):
+        """
+        Return the (meta, body) entry stored for the query, or None.
+        """
+        path = self.path(url, params)
+        try:
+            with open(path, 'rb') as entry:
+                meta = json.loads(entry.readline().decode('utf-8'))
+                body = entry.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return meta, body
+
+    def is_fresh(self, meta):
+        return time.time() - meta['stored_at'] < self.ttl
+
+    def validators(self, meta):
+        """
+        Return the headers of a conditional request for the entry.
+        """
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def set(self, url, params, body, headers):
+        meta = {
+            'url': url,
+            'stored_at': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            }
+        path = self.path(url, params)
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary, 'wb') as entry:
+            entry.write(json.dumps(meta).encode('utf-8') + b'\n')
+            entry.write(body)
+        os.replace(temporary, path)
+        self.evict()
+
+    def revalidated(self, url, params, meta, body):
+        """
+        Mark the entry as fresh again, after a 304 Not Modified response.
+        """
+        self.set(url, params, body, {
+            'ETag': meta.get('etag'),
+            'Last-Modified': meta.get('last_modified'),
+            })
+
+    def evict(self):
+        """
+        Delete the least recently used entries while the cache is too big.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.cache'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+
+class OffClient:
+    """
+    Client for the Open Food Facts search API.
+    One keep-alive session is shared by all the threads using the client:
+    its connection pool holds [pool_size] connections, each request has
+    a (connect, read) [timeout] and failed requests are retried
+    [retries] times, waiting [backoff] * 2^n seconds between attempts.
+    Responses are stored in the ResponseCache [cache], if any.
+    """
+
+    def __init__(self, url=SEARCH_URL, timeout=(3.05, 30), retries=3,
+            backoff=0.5, pool_size=10, cache=None):
+        self.url = url
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+                ),
+            )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def search(self, params):
+        """
+        Run a search with [params] and return the decoded JSON response.
+        """
+        return json.loads(b''.join(self.get_chunks(params)).decode('utf-8'))
+
+    def get_chunks(self, params):
+        """
+        Run a search with [params] and yield the response body as bytes
+        chunks, while it is downloaded. Fresh cached responses are used
+        without any request, stale ones are revalidated.
+        """
+        entry = self.cache.get(self.url, params) if self.cache else None
+        if entry is not None and self.cache.is_fresh(entry[0]):
+            yield entry[1]
+            return
+        headers = self.cache.validators(entry[0]) if entry is not None else {}
+        response = self.session.get(self.url, params=params, headers=headers,
+            timeout=self.timeout, stream=True)
+        try:
+            if response.status_code == 304 and entry is not None:
+                self.cache.revalidated(self.url, params, *entry)
+                yield entry[1]
+                return
+            response.raise_for_status()
+            body = []
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if self.cache:
+                    body.append(chunk)
+                yield chunk
+            if self.cache:
+                self.cache.set(self.url, params, b''.join(body), response.headers)
+        finally:
+            response.close()
+
+    def iter_search(self, params, page_size=100, max_pages=50):
+        """
+        Run a search with [params] and yield the products one at a time.
+        Pages of [page_size] products are requested lazily, the next one
+        only when the previous one is exhausted: stop iterating and no more
+        data is downloaded. Each page is parsed while it is read.
+        """
+        for page in range(1, max_pages + 1):
+            page_params = dict(params, page=page, page_size=page_size)
+            chunks = self.get_chunks(page_params)
+            products_number = 0
+            try:
+                for product in iter_json_array(chunks, 'products'):
+                    products_number += 1
+                    yield product
+                # Read the end of the page so that it gets cached.
+                for chunk in chunks:
+                    pass
+            finally:
+                chunks.close()
+            if products_number < page_size:
+                break
+
+    def close(self):
+        self.session.close()
+
+
+class OffUnavailable(Exception):
+    """
+    Open Food Facts did not answer a search, or is not asked for a while.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service: after [threshold] failures in a row
+    the circuit opens and calls are refused for [reset_timeout] seconds.
+    Then one trial call is let through: its success closes the circuit,
+    its failure opens it again.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.trial else 'open'
+
+    def allow(self):
+        """
+        Tell whether a call may be made now.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class SearchProxy:
+    """
+    Open Food Facts searches for the views, which must not wait on a slow
+    or failing server. The [client] should have short timeouts and no
+    retries: its failures feed the [breaker], and no request is made
+    while it is open. Results are stored in the client's cache: fresh
+    ones are served as is, stale ones younger than [stale] more seconds
+    are served at once while a thread revalidates them, and older ones
+    are only served when the request fails. OffUnavailable is raised
+    when there is nothing to serve.
+    """
+
+    def __init__(self, client, breaker, stale=24 * 60 * 60):
+        self.client = client
+        self.cache = client.cache
+        self.breaker = breaker
+        self.stale = stale
+        self.revalidating = set()
+        self.lock = threading.Lock()
+
+    def search(self, params):
+        """
+        Run a search with [params] and return the decoded JSON response.
+        """
+        entry = self.cache.get(self.client.url, params)
+        if entry is not None:
+            age = time.time() - entry[0]['stored_at']
+            if age < self.cache.ttl:
+                return json.loads(entry[1].decode('utf-8'))
+            if age < self.cache.ttl + self.stale:
+                self.revalidate(params)
+                return json.loads(entry[1].decode('utf-8'))
+        try:
+            return self.fetch(params)
+        except OffUnavailable:
+            if entry is None:
+                raise
+            return json.loads(entry[1].decode('utf-8'))
+
+    def fetch(self, params):
+        """
+        Request a search with [params], through the circuit breaker.
+        """
+        if not self.breaker.allow():
+            raise OffUnavailable("Circuit open after {} failures.".format(self.breaker.failures))
+        try:
+            result = self.client.search(params)
+        except (requests.RequestException, ValueError) as error:
+            self.breaker.failure()
+            raise OffUnavailable(str(error)) from error
+        self.breaker.success()
+        return result
+
+    def revalidate(self, params):
+        """
+        Refresh the cached search with [params] in a thread, unless it
+        is already being refreshed.
+        """
+        key = self.cache.path(self.client.url, params)
+        with self.lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        def run():
+            try:
+                self.fetch(params)
+            except OffUnavailable:
+                pass
+            finally:
+                with self.lock:
+                    self.revalidating.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+_client = None
+
+
+def get_client():
+    """
+    Return the search proxy shared by the views, with the timeouts,
+    circuit breaker and cache set up in the settings.
+    """
+    global _client
+    if _client is None:
+        options = getattr(settings, 'OFF_SEARCH', {})
+        client = OffClient(
+            timeout=(options.get('CONNECT_TIMEOUT', 1), options.get('READ_TIMEOUT', 3)),
+            retries=0,
+            cache=ResponseCache.from_settings(),
+            )
+        breaker = CircuitBreaker(
+            threshold=options.get('FAILURES', 5),
+            reset_timeout=options.get('RESET_TIMEOUT', 30),
+            )
+        _client = SearchProxy(client, breaker, stale=options.get('STALE', 24 * 60 * 60))
+    return _client
@@ -0,0 +1,110 @@
+"""
+Ranking of substitutes by category similarity.
+
+Each product is a sparse vector over its categories. The weight of a
+category grows with its specificity in the product hierarchy (low
+Position.rank) and with its rarity in the catalog (inverse document
+frequency), so that sharing 'Chocolate spreads' counts far more than
+sharing 'Foods'. Candidates are scored by the weighted overlap (dot
+product) of their vectors, divided by the squared norm of the product so
+that a candidate with the very same categories scores 1.
+"""
+import heapq
+import math
+
+
+def category_weight(rank, idf):
+    return idf / (rank + 1)
+
+
+class SimilarityIndex:
+    """
+    Category hierarchies of the catalog, built in one pass over [positions],
+    (product id, category id, rank) rows, with the vectors of the
+    [candidates] ids and their inverted index by category.
+    """
+
+    def __init__(self, positions, candidates):
+        hierarchies = {}
+        frequencies = {}
+        for product_id, category_id, rank in positions:
+            hierarchies.setdefault(product_id, []).append((rank, category_id))
+            frequencies[category_id] = frequencies.get(category_id, 0) + 1
+        size = len(hierarchies)
+        idf = {
+            category_id: math.log(1 + size / frequency)
+            for category_id, frequency in frequencies.items()
+            }
+
+        self.hierarchies = hierarchies
+        self.weights = {}
+        for hierarchy in hierarchies.values():
+            hierarchy.sort()
+            for rank, category_id in hierarchy:
+                self.weights[rank, category_id] = category_weight(rank, idf[category_id])
+
+        self.vectors = {}
+        self.postings = {}
+        for product_id in sorted(set(candidates) & set(hierarchies)):
+            self.vectors[product_id] = self.vector(hierarchies[product_id])
+            for category_id in self.vectors[product_id]:
+                self.postings.setdefault(category_id, []).append(product_id)
+        self.cache = {}
+
+    def vector(self, hierarchy):
+        vector = {}
+        for rank, category_id in hierarchy:
+            vector[category_id] = vector.get(category_id, 0) + self.weights[rank, category_id]
+        return vector
+
+    def best(self, product_id, limit=12, pool=5):
+        """
+        Return the [limit] best candidates for [product_id], as
+        (candidate id, score, level) tuples, the best first. 'level' is
+        the rank of the most specific category they share.
+        Products with the same hierarchy share the same candidates, which
+        are scored once.
+        """
+        hierarchy = self.hierarchies.get(product_id)
+        if not hierarchy:
+            return []
+        key = (tuple(hierarchy), limit, pool)
+        if key not in self.cache:
+            self.cache[key] = self.score(hierarchy, limit + 1, pool)
+        return [best for best in self.cache[key] if best[0] != product_id][:limit]
+
+    def score(self, hierarchy, limit, pool):
+        """
+        Return the [limit] best candidates for the category [hierarchy].
+        Categories are walked from the most specific: once [pool] times
+        [limit] candidates are found, the more generic categories only
+        add to their scores instead of bringing new candidates.
+        """
+        vector = self.vector(hierarchy)
+        scores = {}
+        levels = {}
+        for rank, category_id in hierarchy:
+            weight = vector[category_id]
+            if len(scores) < limit * pool:
+                for candidate in self.postings.get(category_id, ()):
+                    scores[candidate] = scores.get(candidate, 0) + (
+                        weight * self.vectors[candidate][category_id])
+                    levels.setdefault(candidate, rank)
+            else:
+                for candidate in scores:
+                    candidate_weight = self.vectors[candidate].get(category_id)
+                    if candidate_weight:
+                        scores[candidate] += weight * candidate_weight
+        norm = sum(weight * weight for weight in vector.values()) or 1
+        best = heapq.nsmallest(limit, (
+            (-score / norm, candidate)
+            for candidate, score in scores.items()
+            ))
+        return [(candidate, -score, levels[candidate]) for score, candidate in best]
+
+    def rank_all(self, limit=12):
+        """
+        Yield (product id, best candidates) for the whole catalog.
+        """
+        for product_id in self.hierarchies:
+            yield product_id, self.best(product_id, limit)
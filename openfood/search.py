@@ -0,0 +1,179 @@
+"""
+Full-text search of the catalog, over the product names, brands and
+category names, the names weighing most. The index lives next to the
+catalog tables, in a SQLite FTS5 table or a Postgres tsvector table with
+a GIN index (see migration 0009), and is rebuilt with the catalog data
+(see catalog.rebuild), in one transaction so that searches keep reading
+the previous index meanwhile. Names are indexed by their search key, so
+that accents and case do not matter. Other databases fall back to a
+LIKE search on the search keys.
+Only a window of the matches is ranked, so that broad terms cost no
+more than precise ones on a large catalog.
+"""
+from collections import OrderedDict
+from django.db import connection, transaction
+from openfood.text import fold, search_key
+from openfood.models import Product
+
+import re
+
+WORD = re.compile(r'\w+')
+WINDOW = 200
+WEIGHTS = (10, 3, 1)
+
+
+def score(words, *fields):
+    """
+    Return the relevance of a product, given its name, brand and
+    categories [fields], for the folded query [words]: the weights of
+    the fields holding each word, then the shortest names first.
+    """
+    total = 0
+    for weight, field in zip(WEIGHTS, fields):
+        field = fold(field)
+        for word in words:
+            if word not in field:
+                continue
+            tokens = WORD.findall(field)
+            if word in tokens:
+                total += weight
+            elif any(token.startswith(word) for token in tokens):
+                total += weight / 2
+    return total, -len(fields[0])
+
+
+class SearchBackend:
+    """
+    Search on the product search keys, without ranking: the keys starting
+    with the query first, with an index range lookup, then the keys
+    holding it, with a LIKE scan.
+    """
+    table = None
+
+    def rebuild(self):
+        return 0
+
+    def search(self, text, limit=10):
+        key = search_key(text)
+        if not key:
+            return []
+        ids = list(Product.objects.filter(
+            search_key__gte=key, search_key__lt=key + '\uffff').order_by(
+            'search_key').values_list('pk', flat=True)[:limit])
+        if len(ids) < limit:
+            ids.extend(Product.objects.filter(search_key__contains=key).exclude(
+                pk__in=ids).values_list('pk', flat=True)[:limit - len(ids)])
+        return ids
+
+
+class SQLiteSearch(SearchBackend):
+    """
+    FTS5 table. bm25 ranks every match, which costs too much on broad
+    terms: a window of WINDOW matches is ranked in Python instead. It is
+    filled with the matches on the names then on any column, of the
+    words first, then of the last word as a prefix, whose expansion is
+    much slower on frequent words.
+    """
+    table = 'openfood_product_fts'
+
+    def rebuild(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {}".format(self.table))
+            cursor.execute("""
+                INSERT INTO {} (rowid, product_name, brand, categories)
+                SELECT p.id, p.search_key, p.brand, COALESCE((
+                    SELECT group_concat(c.category_name, ' ')
+                    FROM openfood_position po
+                    JOIN openfood_category c ON c.id = po.category_id
+                    WHERE po.product_id = p.id), '')
+                FROM openfood_product p
+                """.format(self.table))
+            return cursor.rowcount
+
+    def search(self, text, limit=10):
+        words = WORD.findall(search_key(text))
+        if not words:
+            return []
+        exact = ' '.join('"{}"'.format(word) for word in words)
+        prefix = exact + '*'
+        rows = OrderedDict()
+        with connection.cursor() as cursor:
+            for query in (exact, prefix):
+                for match in ('{product_name} : (' + query + ')', query):
+                    if len(rows) >= WINDOW:
+                        break
+                    cursor.execute("""
+                        SELECT rowid, product_name, brand, categories FROM {table}
+                        WHERE {table} MATCH %s LIMIT %s
+                        """.format(table=self.table), [match, WINDOW])
+                    for row in cursor.fetchall():
+                        rows.setdefault(row[0], row)
+        ranked = sorted(rows.values(), key=lambda row: score(words, *row[1:]), reverse=True)
+        return [row[0] for row in ranked[:limit]]
+
+
+class PostgresSearch(SearchBackend):
+    """
+    tsvector table with a GIN index. The first WINDOW matches are ranked
+    with ts_rank (name A, brand B, categories C).
+    """
+    table = 'openfood_product_search'
+
+    def rebuild(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            # TRUNCATE would lock the readers out until the commit.
+            cursor.execute("DELETE FROM {}".format(self.table))
+            cursor.execute("""
+                INSERT INTO {} (product_id, document)
+                SELECT p.id,
+                    setweight(to_tsvector('simple', p.search_key), 'A') ||
+                    setweight(to_tsvector('simple', p.brand), 'B') ||
+                    setweight(to_tsvector('simple', COALESCE((
+                        SELECT string_agg(c.category_name, ' ')
+                        FROM openfood_position po
+                        JOIN openfood_category c ON c.id = po.category_id
+                        WHERE po.product_id = p.id), '')), 'C')
+                FROM openfood_product p
+                """.format(self.table))
+            return cursor.rowcount
+
+    def search(self, text, limit=10):
+        words = WORD.findall(search_key(text))
+        if not words:
+            return []
+        query = ' & '.join(words) + ':*'
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT product_id FROM (
+                    SELECT product_id, document FROM {}
+                    WHERE document @@ to_tsquery('simple', %s) LIMIT %s
+                    ) matches, to_tsquery('simple', %s) query
+                ORDER BY ts_rank(document, query) DESC LIMIT %s
+                """.format(self.table), [query, WINDOW, query, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearch,
+    'postgresql': PostgresSearch,
+    }
+
+
+def get_backend():
+    return BACKENDS.get(connection.vendor, SearchBackend)()
+
+
+def rebuild():
+    """
+    Rebuild the search index from the catalog, return its size.
+    """
+    return get_backend().rebuild()
+
+
+def search_products(text, limit=10):
+    """
+    Return the [limit] products matching [text] best, the best first.
+    """
+    ids = get_backend().search(text, limit)
+    products = Product.objects.in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
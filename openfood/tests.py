@@ -1,10 +1,49 @@
+import gzip
+import io
+import json
+import os
 import requests
+import tempfile
+import time
 from requests.models import Response
 from django.test import TestCase, Client
+from unittest import skipUnless
 from unittest.mock import Mock, patch, MagicMock
 from django.core.management import call_command
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from .management.commands.initialize import Collector
-from .models import Product, Category, Position
+from .checkpoint import Checkpoint
+from .fake_off import FakeOffServer
+from .management.commands.benchmark import Benchmark, SamplingBenchmark
+from .ranking import SimilarityIndex
+from . import cache, fuzzy, search, text
+from . import index as catalog_index
+from .cache import LRUMemoryCache
+from .off_client import (
+    CircuitBreaker, OffClient, OffUnavailable, ResponseCache, SearchProxy, SEARCH_URL,
+    iter_json_array)
+from .models import (
+    Product, Category, Position, StagedProduct, Substitute, CatalogVersion)
+from django.contrib.auth.models import User
+from openuser.models import Profile
+
+
+def fetched(code, grade='a', categories=('CatC', 'CatH')):
+    """
+    Return a product as fetched from OFF, for the collector tests.
+    """
+    return {
+        'product_name': 'Product{}'.format(code),
+        'nutrition_grades': grade,
+        'url': 'http://off/product-{}'.format(code),
+        'code': code,
+        'brands': 'Brand',
+        'stores': 'Store',
+        'image_url': 'http://off/product-{}.jpg'.format(code),
+        'categories_hierarchy': list(categories),
+    }
 
 
 class CommandsTestCase(TestCase):
@@ -15,7 +54,8 @@ class CommandsTestCase(TestCase):
     def test_initialize(self):
         response = Response()
         response.status_code = 200
-        response.json = MagicMock(return_value={
+        response._content_consumed = True
+        response._content = json.dumps({
             'products': [
             {
                 'product_name': 'ProductA',
@@ -68,18 +108,460 @@ class CommandsTestCase(TestCase):
                 'categories_hierarchy': ['CatC', 'CatH', 'CatS', 'CatZ'],
             }
             ]
-        })
+        }).encode()
         mocked_get = MagicMock(return_value=response)
-        with patch('requests.get', mocked_get):
+        with patch('requests.Session.get', mocked_get):
             collector = Collector(
                 url="https://fr.openfoodfacts.org/cgi/search.pl",
                 number_by_grade=[
                     ('a', 1), ('b', 1), ('c', 1), ('d', 1), ('e', 1)
                 ],
                 categories=['CatB', 'CatC', 'CatH', 'CatI', 'CatS', 'CatZ'],
+                workers=4,
                 )
             collector.populate()
 
+        self.assertEqual(mocked_get.call_count, 30)
+        self.assertEqual(mocked_get.call_args[1]['timeout'], (3.05, 30))
+        # Every query returns ProductA first: it is registered once.
+        self.assertEqual(len(collector.products), 1)
+        self.assertEqual(collector.duplicates, 29)
+        self.assertEqual(Product.objects.count(), 1)
+
+    def test_register_bulk(self):
+        " Bulk registration stores the same rows as the one by one way."
+        products = [
+            {
+                'product_name': 'Product{}'.format(i),
+                'nutrition_grades': 'abcde'[i % 5],
+                'url': 'http://off/product-{}'.format(i),
+                'code': str(i),
+                'brands': 'Brand',
+                'stores': 'Store',
+                'image_url': 'http://off/product-{}.jpg'.format(i),
+                'categories_hierarchy': ['CatC', 'CatH', 'Cat{}'.format(i % 3)],
+            } for i in range(20)
+        ]
+        Category.objects.create(category_name='CatC')
+        collector = Collector()
+        collector.products = products
+        with CaptureQueriesContext(connection) as queries:
+            collector.register_bulk()
+        self.assertLessEqual(len(queries), 10)
+        self.assertEqual(Product.objects.count(), 20)
+        self.assertEqual(Category.objects.count(), 5)
+        self.assertEqual(Position.objects.count(), 60)
+        product = Product.objects.get(product_name='Product4')
+        self.assertEqual(product.grade, 'e')
+        self.assertEqual(product.search_key, 'product4')
+        self.assertEqual(
+            list(product.position_set.order_by('rank').values_list(
+                'category__category_name', flat=True)),
+            ['Cat1', 'CatH', 'CatC'],
+            )
+
+    def test_refresh_keeps_favorites(self):
+        " Emptying then registering again updates the kept favorites."
+        products = [fetched(str(i), categories=('CatC', 'Cat{}'.format(i))) for i in range(3)]
+        collector = Collector()
+        collector.products = products
+        collector.register_bulk()
+        favorite = Product.objects.get(barcode='1')
+        Product.objects.filter(pk=favorite.pk).update(favorized=1)
+        collector.empty()
+        products[1] = dict(products[1], product_name='Renamed',
+            categories_hierarchy=['CatC', 'CatR'])
+        collector.register_bulk()
+        self.assertEqual(Product.objects.count(), 3)
+        product = Product.objects.get(barcode='1')
+        self.assertEqual((product.pk, product.product_name, product.favorized),
+            (favorite.pk, 'Renamed', 1))
+        self.assertEqual(
+            list(product.position_set.order_by('rank').values_list(
+                'category__category_name', flat=True)),
+            ['CatR', 'CatC'],
+            )
+        collector.empty()
+        collector.register()
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(Product.objects.get(barcode='1').position_set.count(), 2)
+
+    def test_add_products_merges_duplicates(self):
+        " A product fetched under several categories is kept once."
+        collector = Collector()
+        collector.add_products([
+            fetched(1, categories=['Snacks', 'Biscuits']), fetched(2, categories=['Snacks'])])
+        collector.add_products([
+            fetched('1', categories=['Snacks', 'Sweet snacks']), fetched(3, categories=['Snacks'])])
+        self.assertEqual([product['code'] for product in collector.products], [1, 2, 3])
+        self.assertEqual(
+            collector.products[0]['categories_hierarchy'],
+            ['Snacks', 'Biscuits', 'Sweet snacks'],
+            )
+        self.assertEqual(collector.duplicates, 1)
+
+    def test_register_incremental(self):
+        " Incremental refresh keeps ids and only touches what changed."
+        collector = Collector()
+        collector.products = [fetched(1), fetched(2), fetched(3), fetched(4)]
+        collector.register_bulk()
+        ids = dict(Product.objects.values_list('barcode', 'pk'))
+        Product.objects.filter(barcode='4').update(favorized=1)
+
+        collector.products = [
+            fetched(1), fetched(2, grade='c'), fetched(2, grade='c'),
+            fetched(5, categories=('CatC', 'CatZ')),
+            ]
+        counts = collector.register_incremental()
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'unchanged': 1, 'deleted': 1})
+        self.assertEqual(Product.objects.get(barcode='1').pk, ids['1'])
+        self.assertEqual(Product.objects.get(pk=ids['2']).grade, 'c')
+        self.assertFalse(Product.objects.filter(barcode='3').exists())
+        self.assertTrue(Product.objects.filter(barcode='4').exists())
+        self.assertEqual(
+            list(Product.objects.get(barcode='5').position_set.order_by('rank').values_list(
+                'category__category_name', flat=True)),
+            ['CatZ', 'CatC'],
+            )
+
+        collector.products = [fetched(1), fetched(2, grade='c', categories=('CatH',))]
+        counts = collector.register_incremental()
+        self.assertEqual(counts, {'inserted': 0, 'updated': 1, 'unchanged': 1, 'deleted': 1})
+        self.assertEqual(Position.objects.filter(product_id=ids['2']).count(), 1)
+
+    def test_import_dump(self):
+        " JSONL and CSV dumps, compressed or not, are imported with quotas."
+        products = [
+            {
+                'code': str(i),
+                'product_name': 'Fromage {}'.format(i),
+                'nutrition_grades': 'ab'[i % 2],
+                'brands': 'Brand',
+                'categories_hierarchy': ['en:dairies', 'en:cheeses'],
+            } for i in range(6)
+        ]
+        products.append({'code': '6', 'product_name': 'Soda', 'nutrition_grades': 'e',
+            'categories_hierarchy': ['en:beverages']})
+        products.append({'code': '7', 'product_name': 'No grade',
+            'categories_hierarchy': ['en:cheeses']})
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl = os.path.join(directory, 'products.jsonl.gz')
+            with gzip.open(jsonl, 'wt', encoding='utf-8') as dump:
+                for product in products:
+                    dump.write(json.dumps(product) + '\n')
+            with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                call_command('import_dump', jsonl, '--number-by-grade', '2',
+                    '--category', 'Cheeses', '--category', 'Candy', '--batch-size', '3')
+            self.assertIn("No product of the dump under the tags candy:", stdout.getvalue())
+            self.assertEqual(
+                sorted(Product.objects.values_list('barcode', flat=True)),
+                ['0', '1', '2', '3'],
+                )
+
+            csv_dump = os.path.join(directory, 'products.csv')
+            with open(csv_dump, 'w', encoding='utf-8') as dump:
+                dump.write('code\turl\tproduct_name\tbrands\tstores\tcategories_tags'
+                    '\tnutriscore_grade\timage_url\n')
+                dump.write('8\thttp://off/8\tCrème\tB\tS\ten:dairies,en:cheeses\tc\t\n')
+                dump.write('9\thttp://off/9\tSoda\tB\tS\ten:beverages,en:sodas\td\t\n')
+            call_command('import_dump', csv_dump, '--number-by-grade', '0')
+
+        # "Beverage", a default category, is imported under its OFF tag.
+        self.assertEqual(Product.objects.count(), 6)
+        product = Product.objects.get(barcode='8')
+        self.assertEqual(product.grade, 'c')
+        self.assertEqual(
+            list(product.position_set.order_by('rank').values_list(
+                'category__category_name', flat=True)),
+            ['en:cheeses', 'en:dairies'],
+            )
+
+    def test_staged_swap(self):
+        " The staged catalog replaces the live one, favorites included."
+        collector = Collector()
+        collector.products = [fetched(1), fetched(2), fetched(3)]
+        collector.register_bulk()
+        ids = dict(Product.objects.values_list('barcode', 'pk'))
+        user = User.objects.create_user(username='doe')
+        profile = Profile.objects.create(user=user)
+        profile.products.add(ids['3'])
+        Product.objects.filter(pk=ids['3']).update(favorized=1)
+
+        positions = list(Position.objects.filter(product_id__in=[ids['1'], ids['3']]).order_by(
+            'pk').values_list('pk', flat=True))
+        collector.products = [
+            fetched(1, grade='b'), fetched(3), fetched(4, categories=('CatZ',)),
+            ]
+        collector.stage()
+        self.assertEqual(Product.objects.get(pk=ids['1']).grade, 'a')
+        counts = collector.swap()
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'deleted': 1})
+        # Unchanged positions are not rewritten.
+        self.assertEqual(
+            list(Position.objects.filter(product_id__in=[ids['1'], ids['3']]).order_by(
+                'pk').values_list('pk', flat=True)),
+            positions)
+        self.assertEqual(Product.objects.get(pk=ids['1']).grade, 'b')
+        self.assertFalse(Product.objects.filter(pk=ids['2']).exists())
+        self.assertEqual(list(profile.products.values_list('pk', flat=True)), [ids['3']])
+        self.assertEqual(
+            list(Product.objects.get(barcode='4').categories.values_list(
+                'category_name', flat=True)),
+            ['CatZ'],
+            )
+        self.assertEqual(Position.objects.filter(product_id=ids['1']).count(), 2)
+        self.assertEqual(StagedProduct.objects.count(), 0)
+
+    def test_resume_from_checkpoint(self):
+        " A resumed run only fetches and registers the units left."
+        failing_units = [('CatB', 'b')]
+
+        def page(*args, **kwargs):
+            params = kwargs['params']
+            if (params['tag_0'], params['nutrition_grades']) in failing_units:
+                raise requests.ConnectionError("OFF is down")
+            response = Response()
+            response.status_code = 200
+            response._content_consumed = True
+            response._content = json.dumps({'products': [{
+                'product_name': 'Product', 'nutrition_grades': params['nutrition_grades'],
+                'url': 'http://off/product', 'code': params['tag_0'] + params['nutrition_grades'],
+                'brands': 'Brand', 'stores': 'Store', 'image_url': 'http://off/product.jpg',
+                'categories_hierarchy': [params['tag_0']],
+                }]}).encode()
+            return response
+
+        def collector():
+            return Collector(number_by_grade=[('a', 1), ('b', 1)], categories=['CatA', 'CatB'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            with patch('requests.Session.get', MagicMock(side_effect=page)):
+                with self.assertRaises(requests.ConnectionError):
+                    collector().populate(Checkpoint(directory))
+            self.assertEqual(Product.objects.count(), 0)
+
+            # Pretend the first unit was registered before the crash.
+            checkpoint = Checkpoint(directory)
+            checkpoint.mark_registered(('CatA', 'a', 1))
+            Product.objects.create(product_name='Product', grade='a', barcode='CatAa')
+
+            failing_units = []
+            mocked_get = MagicMock(side_effect=page)
+            with patch('requests.Session.get', mocked_get):
+                collector().populate(checkpoint)
+            self.assertEqual(mocked_get.call_count, 1)
+            self.assertEqual(
+                sorted(Product.objects.values_list('barcode', flat=True)),
+                ['CatAa', 'CatAb', 'CatBa', 'CatBb'],
+                )
+
+    def test_iter_json_array(self):
+        " Products are decoded one by one, whatever the chunks boundaries."
+        document = json.dumps({
+            'count': 12345,
+            'skip': {'nested': [1, 2]},
+            'products': [{'code': i, 'product_name': 'Crème n°{}'.format(i)} for i in range(5)],
+            'page_size': 5,
+            }).encode()
+        for size in (1, 3, 7, len(document)):
+            chunks = [document[i:i + size] for i in range(0, len(document), size)]
+            products = list(iter_json_array(chunks, 'products'))
+            self.assertEqual([product['code'] for product in products], list(range(5)))
+            self.assertEqual(products[4]['product_name'], 'Crème n°4')
+        self.assertEqual(list(iter_json_array([b'{"products": []}'], 'products')), [])
+
+    def test_iter_search_stops_requesting_pages(self):
+        " Pages are only requested while products are consumed."
+        def page(*args, **kwargs):
+            response = Response()
+            response.status_code = 200
+            response._content_consumed = True
+            response._content = json.dumps({'products': [
+                {'code': '{}-{}'.format(kwargs['params']['page'], i)} for i in range(10)
+                ]}).encode()
+            return response
+        mocked_get = MagicMock(side_effect=page)
+        with patch('requests.Session.get', mocked_get):
+            products = OffClient().iter_search({'json': 1}, page_size=10)
+            codes = [next(products)['code'] for i in range(15)]
+            products.close()
+        self.assertEqual(codes[14], '2-4')
+        self.assertEqual(mocked_get.call_count, 2)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_benchmark_against_fake_server(self):
+        " The whole pipeline runs against the fake server and is measured."
+        with FakeOffServer(products_number=30) as server:
+            benchmark = Benchmark(server, categories=3, number_by_grade=20, workers=4)
+            results = benchmark.run()
+        self.assertEqual([result['scenario'] for result in results], Benchmark.scenarios)
+        initialize = results[0]
+        self.assertEqual(initialize['http_requests'], 3 * 5)
+        self.assertEqual(initialize['products'], Product.objects.count())
+        self.assertGreater(initialize['queries'], 0)
+        self.assertGreater(initialize['peak_memory'], 0)
+        self.assertEqual(results[2]['products'], Product.objects.count())
+
+    def test_sampling_benchmark(self):
+        " The catalog grows to each size and both sampling methods are measured."
+        results = SamplingBenchmark(sizes=[50, 200], samples=2, batch_size=60).run()
+        self.assertEqual([result['products'] for result in results], [50, 200])
+        self.assertEqual(Product.objects.count(), 200)
+        self.assertGreater(results[1]['random_product_index'], 0)
+        self.assertGreater(results[1]['random_ab_products_index'], 0)
+
+
+@skipUnless(connection.vendor == 'sqlite', "Query plans are checked on SQLite.")
+class QueryPlanTestCase(TestCase):
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.query_plan(queryset)
+        self.assertRegex(plan, 'USING (COVERING )?INDEX {}'.format(index), plan)
+
+    def test_hot_queries_use_indexes(self):
+        " Each hot lookup is an index search, not a table scan."
+        self.assertUsesIndex(Product.objects.filter(barcode='1'), 'sqlite_autoindex_openfood_product')
+        self.assertUsesIndex(
+            Category.objects.filter(category_name='en:foods'), 'sqlite_autoindex_openfood_category')
+        self.assertUsesIndex(Product.objects.filter(grade='e'), 'openfood_pr_grade')
+        self.assertUsesIndex(
+            Product.objects.filter(grade__in=['b', 'c', 'd', 'e']).order_by('product_name'),
+            'openfood_pr_grade')
+        self.assertUsesIndex(
+            Position.objects.filter(category_id=1, product__grade__in=['a', 'b']).values(
+                'product_id'),
+            'openfood_po_categor')
+        self.assertUsesIndex(
+            Position.objects.filter(product_id=1).order_by('rank'), 'openfood_position_product_id')
+        self.assertUsesIndex(
+            Substitute.objects.filter(product_id=1), 'openfood_substitute_product_id')
+        self.assertUsesIndex(
+            Product.objects.filter(search_key__gte='pate', search_key__lt='pate\uffff'),
+            'openfood_product_search_key')
+
+
+class OffClientTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def response(self, status_code=200, body=b'{"products": []}', headers=None):
+        response = Response()
+        response.status_code = status_code
+        response._content_consumed = True
+        response._content = body
+        response.headers.update(headers or {})
+        return response
+
+    def test_cache_hit_and_revalidation(self):
+        " Fresh entries cost no request, stale ones are revalidated."
+        cache = ResponseCache(self.directory.name, ttl=60)
+        client = OffClient(cache=cache)
+        mocked_get = MagicMock(return_value=self.response(
+            body=b'{"products": [{"code": "1"}]}', headers={'ETag': '"v1"'}))
+        with patch('requests.Session.get', mocked_get):
+            self.assertEqual(client.search({'b': 2, 'a': 1})['products'], [{'code': '1'}])
+            self.assertEqual(client.search({'a': 1, 'b': 2})['products'], [{'code': '1'}])
+            self.assertEqual(mocked_get.call_count, 1)
+
+            cache.ttl = 0
+            mocked_get.return_value = self.response(status_code=304, body=b'')
+            self.assertEqual(client.search({'a': 1, 'b': 2})['products'], [{'code': '1'}])
+            self.assertEqual(mocked_get.call_count, 2)
+            self.assertEqual(mocked_get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+
+    def test_cache_eviction(self):
+        " The least recently used entries are deleted first."
+        cache = ResponseCache(self.directory.name, max_size=2500)
+        for page in range(3):
+            cache.set(SEARCH_URL, {'page': page}, b'x' * 1000, {})
+            os.utime(cache.path(SEARCH_URL, {'page': page}), (page, page))
+        cache.set(SEARCH_URL, {'page': 3}, b'x' * 500, {})
+        self.assertIsNone(cache.get(SEARCH_URL, {'page': 0}))
+        self.assertIsNone(cache.get(SEARCH_URL, {'page': 1}))
+        self.assertIsNotNone(cache.get(SEARCH_URL, {'page': 2}))
+        self.assertIsNotNone(cache.get(SEARCH_URL, {'page': 3}))
+
+
+class SearchProxyTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.server = FakeOffServer(products_number=3).start()
+        self.addCleanup(self.server.stop)
+
+    def proxy(self, ttl=60, stale=60):
+        client = OffClient(self.server.url, timeout=(1, 0.2), retries=0,
+            cache=ResponseCache(self.directory.name, ttl=ttl))
+        self.addCleanup(client.close)
+        return SearchProxy(client, CircuitBreaker(threshold=2, reset_timeout=60), stale=stale)
+
+    def test_circuit_breaker(self):
+        " Slow or failing searches trip the circuit, then cost no request."
+        proxy = self.proxy()
+        self.server.latency = 0.5
+        start = time.monotonic()
+        with self.assertRaises(OffUnavailable):
+            proxy.search({'search_terms': 'slow'})
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.server.latency = 0
+        self.server.error_rate = 1
+        with self.assertRaises(OffUnavailable):
+            proxy.search({'search_terms': 'failing'})
+        self.assertEqual(proxy.breaker.state, 'open')
+        self.server.error_rate = 0
+        requests_number = self.server.requests
+        with self.assertRaises(OffUnavailable):
+            proxy.search({'search_terms': 'ok'})
+        self.assertEqual(self.server.requests, requests_number)
+        proxy.breaker.reset_timeout = 0
+        self.assertEqual(len(proxy.search({'search_terms': 'ok'})['products']), 3)
+        self.assertEqual(proxy.breaker.state, 'closed')
+
+    def test_stale_while_revalidate(self):
+        " Stale results are served at once, then refreshed in the background."
+        proxy = self.proxy(ttl=0)
+        self.assertEqual(len(proxy.search({'search_terms': 'jam'})['products']), 3)
+        self.server.latency = 0.1
+        start = time.monotonic()
+        self.assertEqual(len(proxy.search({'search_terms': 'jam'})['products']), 3)
+        self.assertLess(time.monotonic() - start, 0.1)
+        deadline = time.monotonic() + 5
+        while (proxy.revalidating or self.server.requests < 2) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(proxy.breaker.failures, 0)
+
+        proxy.stale = 0
+        self.server.latency = 0
+        self.server.error_rate = 1
+        self.assertEqual(len(proxy.search({'search_terms': 'jam'})['products']), 3)
+        self.assertEqual(proxy.breaker.failures, 1)
+        with self.assertRaises(OffUnavailable):
+            proxy.search({'search_terms': 'bread'})
+
+    def test_local_results_when_off_is_down(self):
+        " The OFF search page falls back to the local catalog."
+        Product.objects.create(
+            product_name='Confiture de fraises', grade='b', url='', barcode='1',
+            brand='', store='')
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        self.server.error_rate = 1
+        with patch('openfood.views.get_client', return_value=self.proxy()):
+            response = Client().get('/produits/recherche-sur-off/confiture-de-mures/')
+        self.assertTrue(response.context['off_unavailable'])
+        self.assertEqual(
+            [product.product_name for product in response.context['local_products']],
+            ['Confiture de fraises'])
+
 
 class ProductsTestCase(TestCase):
     @classmethod
@@ -165,6 +647,12 @@ class ProductsTestCase(TestCase):
                 new_position.rank = i
                 new_position.save()
 
+    def setUp(self):
+        caches['default'].clear()
+        caches['substitutes'].clear()
+        caches['autocomplete'].clear()
+        catalog_index.index = None
+
     def test_search_product_page(self):
         """
         Test the Index page code response.
@@ -198,6 +686,321 @@ class ProductsTestCase(TestCase):
         response = c.get('/produits/100/substituts/')
         self.assertEqual(response.status_code, 404)
 
+    def test_precomputed_substitutes(self):
+        """
+        Substitutes come from the most specific category shared with
+        a grade A or B product, and are read from the precomputed table.
+        """
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        product_e = Product.objects.get(product_name='ProductE')
+        product_c = Product.objects.get(product_name='ProductC')
+        self.assertEqual(
+            set(Substitute.objects.filter(product=product_e).values_list(
+                'substitute__product_name', 'level')),
+            {('ProductA', 0), ('ProductB', 0)},
+            )
+        self.assertEqual(
+            set(Substitute.objects.filter(product=product_c).values_list('level', flat=True)),
+            {2},
+            )
+        with self.assertNumQueries(2):
+            context = Product.objects.get_substitutes(product_e.pk)
+        self.assertEqual(
+            sorted(product.product_name for product in context['substitutes']),
+            ['ProductA', 'ProductB'],
+            )
+
+    def test_similarity_ranking(self):
+        """
+        Substitutes sharing the most specific and the rarest categories
+        rank first, whatever their number of categories.
+        """
+        foods, snacks, chocolate, crisps, bars = range(1, 6)
+        positions = [
+            (1, chocolate, 0), (1, snacks, 1), (1, foods, 2),
+            (2, crisps, 0), (2, snacks, 1), (2, foods, 2),
+            (3, bars, 0), (3, chocolate, 1), (3, snacks, 2), (3, foods, 3),
+            (4, foods, 0),
+            (5, crisps, 0), (5, snacks, 1), (5, foods, 2),
+            ]
+        index = SimilarityIndex(positions, candidates=[2, 3, 4])
+        best = index.best(1)
+        self.assertEqual([candidate for candidate, score, level in best], [3, 2, 4])
+        self.assertEqual([level for candidate, score, level in best], [0, 1, 2])
+        self.assertGreater(best[0][1], best[1][1])
+        self.assertEqual([candidate for candidate, score, level in index.best(5, limit=1)], [2])
+        self.assertEqual(index.best(6), [])
+
+    @skipUnless(connection.vendor == 'sqlite', "FTS5 search is checked on SQLite.")
+    def test_full_text_search(self):
+        " Hits are ranked by relevance across names, brands and categories."
+        Product.objects.create(
+            product_name='Pâte à tartiner', grade='b', url='', barcode='600000000000',
+            brand='Product maker', store='')
+        self.assertEqual(search.search_products('product'), [])
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        results = search.search_products('product', limit=10)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[-1].product_name, 'Pâte à tartiner')
+        self.assertEqual(
+            [product.product_name for product in search.search_products('PATE tart')],
+            ['Pâte à tartiner'])
+        self.assertEqual(
+            sorted(product.product_name for product in search.search_products('catz')),
+            ['ProductA', 'ProductB', 'ProductE'])
+        self.assertEqual(search.search_products('"*'), [])
+        response = Client().post('/produits/recherche/', {'search': 'pate'})
+        self.assertRedirects(response, '/produits/{}/substituts/'.format(
+            Product.objects.get(barcode='600000000000').pk), fetch_redirect_response=False)
+
+    def test_trigram_index(self):
+        " Unknown words are corrected to the most similar known ones."
+        index = fuzzy.TrigramIndex.from_keys(['camembert de normandie', 'comte 18 mois'])
+        self.assertNotIn('18', index.words)
+        self.assertEqual(index.similar('camenbert'), 'camembert')
+        self.assertEqual(index.similar('conte'), 'comte')
+        self.assertIsNone(index.similar('zzz'))
+        self.assertEqual(index.correct('Camenbert  NORMANDY'), 'camembert normandie')
+        self.assertIsNone(index.correct('comte 12 mois'))
+
+    @skipUnless(connection.vendor == 'sqlite', "Fuzzy search is checked on SQLite.")
+    def test_fuzzy_search(self):
+        " Misspelled searches are answered from the catalog, not from OFF."
+        product = Product.objects.create(
+            product_name='Camembert de Normandie', grade='c', url='', barcode='600000000000',
+            brand='', store='')
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        self.assertEqual(search.search_products('camenbert'), [])
+        self.assertEqual(fuzzy.search_products('camenbert'), [product])
+        self.assertEqual(fuzzy.search_products('qwxz'), [])
+        response = Client().post('/produits/recherche/', {'search': 'camenbert normandi'})
+        self.assertRedirects(response, '/produits/{}/substituts/'.format(product.pk),
+            fetch_redirect_response=False)
+
+    def test_autocomplete(self):
+        " Names are matched by folded prefix, from memory, grade A aside."
+        Product.objects.create(
+            product_name='Écrémé Léger', grade='c', url='', barcode='600000000000',
+            brand='', store='')
+        c = Client()
+        response = c.get('/api/get_products/', {'term': 'product'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(
+            response.json(), ['ProductB', 'ProductC', 'ProductD', 'ProductE'])
+        with self.assertNumQueries(0):
+            response = c.get('/api/get_products/', {'term': 'ecreme l'},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json(), ['Écrémé Léger'])
+        index = catalog_index.get_index()
+        self.assertEqual(index.autocomplete('PRODUCT', number=2), ['ProductA', 'ProductB'])
+        self.assertEqual(index.autocomplete('x'), [])
+
+    def test_autocomplete_caching(self):
+        " Answers are cached, and validated by the catalog version."
+        c = Client()
+        response = c.get('/api/get_products/', {'term': 'product'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        etag = response['ETag']
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age=3600', response['Cache-Control'])
+        self.assertIn('X-Requested-With', response['Vary'])
+        with patch.object(catalog_index.CatalogIndex, 'autocomplete') as autocomplete:
+            response = c.get('/api/get_products/', {'term': ' PRODUCT'},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertFalse(autocomplete.called)
+        self.assertEqual(
+            response.json(), ['ProductB', 'ProductC', 'ProductD', 'ProductE'])
+        response = c.get('/api/get_products/', {'term': 'product'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        catalog_index.index = None
+        response = c.get('/api/get_products/', {'term': 'product'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_search_key(self):
+        " Search keys hold neither accents, ligatures, case nor extra spaces."
+        self.assertEqual(text.search_key(' Crème  fraîche\tÉPAISSE '), 'creme fraiche epaisse')
+        self.assertEqual(text.search_key('Pâté'), 'pate')
+        self.assertEqual(text.search_key('Œufs'), 'oeufs')
+        product = Product.objects.create(
+            product_name='Œufs frais', grade='b', url='', barcode='600000000000',
+            brand='', store='')
+        self.assertEqual(product.search_key, 'oeufs frais')
+        backend = search.SearchBackend()
+        self.assertEqual(backend.search('OEUFS'), [product.pk])
+        self.assertEqual(backend.search('frais'), [product.pk])
+        self.assertEqual(len(backend.search('product', limit=3)), 3)
+
+    def test_live_substitutes_query_budget(self):
+        """
+        The live lookup takes the most specific category by rank, in a
+        fixed number of queries, the catalog index being loaded once.
+        """
+        product_e = Product.objects.get(product_name='ProductE')
+        product_c = Product.objects.get(product_name='ProductC')
+        product_d = Product.objects.get(product_name='ProductD')
+        with self.assertNumQueries(6):
+            context = Product.objects.find_substitutes(product_e.pk)
+        self.assertEqual(
+            sorted(product.product_name for product in context['substitutes']),
+            ['ProductA', 'ProductB'],
+            )
+        with self.assertNumQueries(4):
+            context = Product.objects.find_substitutes(product_c.pk)
+        self.assertEqual(len(context['substitutes']), 2)
+        self.assertNotIn(product_c, context['substitutes'])
+        with self.assertNumQueries(3):
+            context = Product.objects.find_substitutes(product_d.pk)
+        self.assertIsNone(context['substitutes'])
+
+    def test_catalog_index(self):
+        " The index is reloaded when the catalog version changes."
+        index = catalog_index.get_index()
+        product_e = Product.objects.get(product_name='ProductE')
+        category = Category.objects.get(category_name='CatZ')
+        ab_ids = set(Product.objects.filter(grade__in=['a', 'b']).values_list('pk', flat=True))
+        self.assertEqual(index.random_product('e'), product_e.pk)
+        self.assertIsNone(index.random_product('z'))
+        self.assertEqual(set(index.random_ab(category.pk, 6)), ab_ids)
+        self.assertEqual(len(index.random_ab(category.pk, 1)), 1)
+        with self.assertNumQueries(1):
+            self.assertIs(catalog_index.get_index(), index)
+        CatalogVersion.objects.bump()
+        self.assertIsNot(catalog_index.get_index(), index)
+
+    def test_batch_substitutes_api(self):
+        " Substitutes of a batch are resolved with two queries by chunk."
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        product_e = Product.objects.get(product_name='ProductE')
+        c = Client()
+        with self.assertNumQueries(2):
+            response = c.get('/api/substitutes/', {'id': '{},9999'.format(product_e.pk)})
+        self.assertEqual(response.status_code, 200)
+        products = response.json()['products']
+        self.assertEqual([product['found'] for product in products], [True, False])
+        self.assertEqual(
+            sorted(substitute['product_name'] for substitute in products[0]['substitutes']),
+            ['ProductA', 'ProductB'],
+            )
+
+        Substitute.objects.filter(product=product_e).delete()
+        catalog_index.get_index()
+        with self.assertNumQueries(5):
+            response = c.get('/api/substitutes/', {
+                'id': product_e.pk, 'barcode': '400000000000'})
+        products = response.json()['products']
+        self.assertEqual(
+            sorted(substitute['product_name'] for substitute in products[0]['substitutes']),
+            ['ProductA', 'ProductB'],
+            )
+        self.assertEqual(products[1]['product_name'], 'ProductD')
+        self.assertEqual(products[1]['substitutes'], [])
+        call_command('rebuild_catalog', stdout=io.StringIO())
+
+        response = c.get('/api/substitutes/', {'id': [product_e.pk] * 120})
+        self.assertTrue(response.streaming)
+        products = json.loads(b''.join(response.streaming_content).decode('utf-8'))['products']
+        self.assertEqual(len(products), 120)
+        self.assertEqual(len(products[-1]['substitutes']), 2)
+
+        self.assertEqual(c.get('/api/substitutes/', {'id': range(201)}).status_code, 400)
+        self.assertEqual(c.get('/api/substitutes/', {'id': 'x'}).status_code, 400)
+        self.assertEqual(
+            c.get('/api/substitutes/', {'id': product_e.pk, 'number': 0}).status_code, 400)
+        self.assertEqual(
+            c.get('/api/substitutes/', {'id': product_e.pk, 'number': -3}).status_code, 400)
+        self.assertEqual(c.get('/api/substitutes/', {'id': '²'}).status_code, 400)
+        self.assertEqual(
+            c.get('/api/substitutes/', {'id': '9' * 23}).status_code, 400)
+        self.assertEqual(c.get('/api/substitutes/').status_code, 400)
+
+    def test_substitutes_cache(self):
+        " Lookups are cached until the catalog version is bumped."
+        product_e = Product.objects.get(product_name='ProductE')
+        context = cache.get_substitutes(product_e.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_substitutes(product_e.pk), context)
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        with self.assertNumQueries(3):
+            cache.get_substitutes(product_e.pk)
+        with self.assertNumQueries(1):
+            cache.get_substitutes(product_e.pk)
+
+    def test_favorites_excluded_from_substitutes(self):
+        " Favorites are excluded in the lookups, their ids are cached."
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        product_a = Product.objects.get(product_name='ProductA')
+        product_b = Product.objects.get(product_name='ProductB')
+        product_e = Product.objects.get(product_name='ProductE')
+        with self.assertNumQueries(2):
+            Product.objects.get_substitutes(product_e.pk, exclude={product_e.pk})
+        context = Product.objects.get_substitutes(product_e.pk, exclude={product_a.pk})
+        self.assertEqual(context['substitutes'], [product_b])
+        context = Product.objects.find_substitutes(product_e.pk, exclude={product_a.pk})
+        self.assertEqual(context['substitutes'], [product_b])
+
+        user = User.objects.create_user('fan', password='secret-password')
+        profile = Profile.objects.create(user=user)
+        profile.products.add(product_a)
+        self.assertEqual(profile.favorite_ids(), {product_a.pk})
+        with self.assertNumQueries(0):
+            profile.favorite_ids()
+        c = Client()
+        c.login(username='fan', password='secret-password')
+        response = c.get('/produits/{}/substituts/'.format(product_e.pk))
+        self.assertEqual(list(response.context['substitutes']), [product_b])
+        product_b.profiles.add(profile)
+        self.assertEqual(profile.favorite_ids(), {product_a.pk, product_b.pk})
+        response = c.get('/produits/{}/substituts/'.format(product_e.pk))
+        self.assertIsNone(response.context['substitutes'])
+
+        cache_key = profile.favorites_key()
+        caches['default'].set('unrelated', 1)
+        product_b.profiles.clear()
+        self.assertIsNone(caches['default'].get(cache_key))
+        self.assertEqual(caches['default'].get('unrelated'), 1)
+        self.assertEqual(profile.favorite_ids(), {product_a.pk})
+
+    def test_many_favorites_excluded_from_substitutes(self):
+        " Pages are topped up live when favorites take most precomputed places."
+        category = Category.objects.create(category_name='CatMany')
+        product = Product.objects.create(
+            product_name='Many', grade='e', url='', barcode='600000000000', brand='', store='')
+        Position.objects.create(product=product, category=category, rank=0)
+        for i in range(20):
+            candidate = Product.objects.create(
+                product_name='Many {}'.format(i), grade='a', url='',
+                barcode=str(600000000001 + i), brand='', store='')
+            Position.objects.create(product=candidate, category=category, rank=0)
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        precomputed = list(Substitute.objects.filter(product=product).values_list(
+            'substitute_id', flat=True))
+        self.assertEqual(len(precomputed), cache.CACHED_SUBSTITUTES)
+        favorites = set(precomputed[:10])
+        for context in (
+                Product.objects.get_substitutes(product.pk, exclude=favorites),
+                cache.get_substitutes(product.pk, exclude=favorites)):
+            ids = [substitute.pk for substitute in context['substitutes']]
+            self.assertEqual(len(set(ids)), 6)
+            self.assertFalse(favorites.intersection(ids))
+            self.assertNotIn(product.pk, ids)
+
+    def test_lru_memory_cache(self):
+        " The least recently used entries are evicted, expired ones are missing."
+        lru = LRUMemoryCache('test', {'TIMEOUT': 60, 'OPTIONS': {'MAX_ENTRIES': 2}})
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual((lru.get('a'), lru.get('c')), (1, 3))
+        self.assertFalse(lru.add('a', 4))
+        lru.set('d', 4, timeout=-1)
+        self.assertFalse(lru.has_key('d'))
+
     def test_product_detail(self):
         """
         Test display of an existing product, id = 1.
@@ -0,0 +1,31 @@
+"""
+Normalization of the product names for the searches.
+"""
+import re
+import unicodedata
+
+WHITESPACE = re.compile(r'\s+')
+# Ligatures that Unicode does not decompose.
+LIGATURES = str.maketrans({'œ': 'oe', 'Œ': 'OE', 'æ': 'ae', 'Æ': 'AE'})
+
+
+def fold(text):
+    """
+    Return [text] without accents nor case, for the prefix searches.
+    """
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        text = ''.join(
+            character for character in unicodedata.normalize('NFKD', text.translate(LIGATURES))
+            if not unicodedata.combining(character)
+            )
+    return text.casefold()
+
+
+def search_key(text):
+    """
+    Return the search key of [text]: folded, with its whitespace collapsed,
+    cut to the length of Product.search_key.
+    """
+    return WHITESPACE.sub(' ', fold(text or '')).strip()[:255]
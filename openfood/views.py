@@ -1,36 +1,139 @@
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.urls import reverse, reverse_lazy
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
 from .models import Product, Category, Position
 from .forms import SearchForm
+from .off_client import OffUnavailable, get_client
+from . import cache, fuzzy, search
+from .index import get_index
 from django.db.models import Q
-import requests
 import json
 
+SUBSTITUTES_BATCH_MAX = 200
+SUBSTITUTES_BATCH_CHUNK = 50
+# Largest value of an AutoField.
+PRODUCT_ID_MAX = 2 ** 31 - 1
+
+def autocomplete_etag(request):
+    return '"catalog-{}"'.format(get_index(settings.CATALOG_INDEX_MAX_AGE).version)
+
+
+@cache_control(public=True, max_age=settings.AUTOCOMPLETE_MAX_AGE)
+@vary_on_headers('X-Requested-With')
+@condition(etag_func=autocomplete_etag)
 def get_products(request):
     """
     This view provides a JSON set of products of all grades but A.
-    Used by jQuery autocomplete to suggests registered products.
+    Used by jQuery autocomplete to suggests registered products,
+    from the catalog index, through the autocomplete cache.
+    Answers carry the catalog version as ETag: a conditional request for
+    an unchanged catalog gets a 304 response.
     """
     if request.is_ajax():
-        q = request.GET.get('term', '')
-        print("x" + q + "x")
-        products = Product.objects.filter(
-            Q(product_name__istartswith = q) &
-            (Q(grade='e') | Q(grade='d') | Q(grade='c') | Q(grade='b'))
-            ).order_by('product_name')[:10]
-        results = []
-        
-        for product in products:
-            results.append(product.product_name)
-        data = json.dumps(results)
+        index = get_index(settings.CATALOG_INDEX_MAX_AGE)
+        data = cache.get_autocomplete(request.GET.get('term', ''), index)
     else:
         data = 'fail'
     mimetype = 'application/json'
     return HttpResponse(data, mimetype)
 
 
+def product_json(product):
+    return {
+        'id': product.pk,
+        'barcode': product.barcode,
+        'product_name': product.product_name,
+        'grade': product.grade,
+        'brand': product.brand,
+        'url': product.url,
+        'product_img_url': product.product_img_url,
+        }
+
+
+def batch_substitutes(request):
+    """
+    This view provides a JSON set of the substitutes of several products,
+    given as 'id' and/or 'barcode' parameters (repeatable, or comma
+    separated), up to SUBSTITUTES_BATCH_MAX of them.
+    Products are resolved by chunks of SUBSTITUTES_BATCH_CHUNK, with two
+    queries each, and up to three more for the products of the chunk
+    without precomputed substitutes, looked up live together (see
+    ProductManager.batch_substitutes); batches of more than one chunk
+    are streamed.
+    """
+    def values(name):
+        return [
+            value for values in request.GET.getlist(name)
+            for value in values.split(',') if value
+            ]
+
+    ids = values('id')
+    barcodes = values('barcode')
+    if not all(pk.isdecimal() for pk in ids):
+        return JsonResponse({'error': "Product ids must be integers."}, status=400)
+    if any(int(pk) > PRODUCT_ID_MAX for pk in ids):
+        return JsonResponse({'error': "Product ids are at most {}.".format(
+            PRODUCT_ID_MAX)}, status=400)
+    if not ids and not barcodes:
+        return JsonResponse({'error': "Give some 'id' or 'barcode' parameters."}, status=400)
+    if len(ids) + len(barcodes) > SUBSTITUTES_BATCH_MAX:
+        return JsonResponse({'error': "At most {} products by batch.".format(
+            SUBSTITUTES_BATCH_MAX)}, status=400)
+    try:
+        number = min(int(request.GET.get('number', 6)), 12)
+    except ValueError:
+        return JsonResponse({'error': "'number' must be an integer."}, status=400)
+    if number < 1:
+        return JsonResponse({'error': "'number' must be at least 1."}, status=400)
+
+    requested = [('id', int(pk)) for pk in ids] + [('barcode', barcode) for barcode in barcodes]
+    chunks = [
+        requested[i:i + SUBSTITUTES_BATCH_CHUNK]
+        for i in range(0, len(requested), SUBSTITUTES_BATCH_CHUNK)
+        ]
+
+    def resolve(chunk):
+        products = Product.objects.filter(
+            Q(pk__in=[value for key, value in chunk if key == 'id']) |
+            Q(barcode__in=[value for key, value in chunk if key == 'barcode'])
+            )
+        found = {}
+        for product in products:
+            found['id', product.pk] = product
+            found['barcode', product.barcode] = product
+        substitutes = Product.objects.batch_substitutes(
+            [product.pk for product in products], number)
+        for key, value in chunk:
+            product = found.get((key, value))
+            if product is None:
+                yield {key: value, 'found': False}
+            else:
+                result = product_json(product)
+                result['found'] = True
+                result['substitutes'] = [
+                    product_json(substitute) for substitute in substitutes[product.pk]
+                    ]
+                yield result
+
+    if len(chunks) == 1:
+        return JsonResponse({'products': list(resolve(chunks[0]))})
+
+    def stream():
+        yield '{"products": ['
+        separator = ''
+        for chunk in chunks:
+            for result in resolve(chunk):
+                yield separator + json.dumps(result)
+                separator = ', '
+        yield ']}'
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+
 def search_product(request):
     context = {}
     form = SearchForm(request.POST or None)
@@ -41,7 +144,9 @@ def search_product(request):
     if form.is_valid(): 
         user_search = form.cleaned_data['search']
         context['search'] = user_search
-        matching_products = Product.objects.filter(product_name__icontains=context['search'])
+        matching_products = (
+            search.search_products(context['search'], 1) or
+            fuzzy.search_products(context['search'], 1))
 
         if matching_products:
             context['result'] = matching_products[0]
@@ -55,22 +160,37 @@ def search_product(request):
         return render(request, 'openfood/index.html', context)
 
 
+def local_products(text, limit=10):
+    """
+    Return local products matching one of the words of [text], the
+    longest first: what is left to show when OFF does not answer.
+    """
+    for word in sorted(text.split(), key=len, reverse=True):
+        products = search.search_products(word, limit) or fuzzy.search_products(word, limit)
+        if products:
+            return products
+    return []
+
+
 def search_on_off(request, search):
     context = {}
     context['user_search'] = search.replace("-", " ")
 
-    url="https://fr.openfoodfacts.org/cgi/search.pl"
-
     args = {
             'action': "process",
             'search_terms': context['user_search'],
             'json': 1,
             'page_size': 10,
             }
-    response = requests.get(url, params=args)
+    try:
+        response = get_client().search(args)
+    except OffUnavailable:
+        response = {'products': []}
+        context['off_unavailable'] = True
+        context['local_products'] = local_products(context['user_search'])
     products = []
 
-    for product in response.json()["products"]:
+    for product in response["products"]:
         try:
             new_product = {}
             new_product['product_name'] = product['product_name']
@@ -90,19 +210,29 @@ def get_substitutes_on_off(request, barcode):
     pass
 
     
+def favorite_ids(request):
+    """
+    Return the ids of the user's favorite products, never shown as substitutes.
+    """
+    if request.user.is_authenticated and hasattr(request.user, 'profile'):
+        return request.user.profile.favorite_ids()
+    return frozenset()
+
+
 def product_substitutes(request, pk):
-    context = Product.objects.get_substitutes(pk)
+    context = cache.get_substitutes(pk, exclude=favorite_ids(request))
     request.session["currentsearch"] = pk
     context["currentsearch"] = request.session["currentsearch"]
-    return render(request, 'openfood/product_substitutes.html', context) # TODO Do not display products wich are already in user favorites ! (hard!)
+    return render(request, 'openfood/product_substitutes.html', context)
 
 
 def ramdom_product(request):
-    context = {}
-    product_e = Product.objects.filter(grade='e').order_by('?').first()
-    context["product"] = product_e
-    context = Product.objects.get_substitutes(product_e.pk)
-    context["currentsearch"] = request.session["currentsearch"] = "random_{}".format(product_e.pk)
+    index = get_index()
+    pk = index.random_product('e')
+    if pk is None:
+        raise Http404("No product of grade E.")
+    context = cache.get_substitutes(pk, exclude=favorite_ids(request), version=index.version)
+    context["currentsearch"] = request.session["currentsearch"] = "random_{}".format(pk)
     return render(request, 'openfood/product_substitutes.html', context)
 
 
@@ -1,4 +1,7 @@
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from openfood.models import Product
 
@@ -9,3 +12,37 @@ class Profile(models.Model):
     def __str__(self):
         return "{}-profile (id={})".format(self.user.username, self.user.id)
 
+    def favorites_key(self):
+        return 'favorites:{}'.format(self.pk)
+
+    def favorite_ids(self):
+        """
+        Return the ids of the favorite products, as a frozenset kept in
+        the default cache until the favorites change.
+        """
+        ids = cache.get(self.favorites_key())
+        if ids is None:
+            ids = frozenset(self.products.values_list('pk', flat=True))
+            cache.set(self.favorites_key(), ids)
+        return ids
+
+
+@receiver(m2m_changed, sender=Profile.products.through)
+def favorites_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Forget the cached favorites of the profiles whose products changed.
+    Before a product's profiles are cleared, their ids are kept on the
+    product for the post_clear signal, which does not give them.
+    """
+    if action == 'pre_clear' and reverse:
+        instance.cleared_profile_ids = list(instance.profiles.values_list('pk', flat=True))
+        return
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        cache.delete(instance.favorites_key())
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('cleared_profile_ids', ())
+    if pk_set:
+        cache.delete_many([Profile(pk=pk).favorites_key() for pk in pk_set])
@@ -120,6 +120,61 @@ STATICFILES_DIRS = [
     ]
 
 
+# On-disk cache of Open Food Facts responses (see openfood.off_client).
+OFF_CACHE = {
+    'DIR': os.path.join(BASE_DIR, 'off_cache'),
+    'TTL': 60 * 60,
+    'MAX_SIZE': 100 * 1024 * 1024,
+}
+
+# Open Food Facts searches of the views (see openfood.off_client.SearchProxy):
+# seconds to connect and between bytes read, failures in a row opening the
+# circuit, seconds it stays open, seconds stale results are still served
+# while they are refreshed.
+OFF_SEARCH = {
+    'CONNECT_TIMEOUT': 1,
+    'READ_TIMEOUT': 3,
+    'FAILURES': 5,
+    'RESET_TIMEOUT': 30,
+    'STALE': 24 * 60 * 60,
+}
+
+# The substitutes cache can use any backend, e.g. a file based one:
+# {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#  'LOCATION': os.path.join(BASE_DIR, 'substitutes_cache')}
+# or a Redis server, with django-redis:
+# {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379/1'}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'substitutes': {
+        'BACKEND': 'openfood.cache.LRUMemoryCache',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    'autocomplete': {
+        'BACKEND': 'openfood.cache.LRUMemoryCache',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
+}
+
+# Seconds during which a worker trusts its catalog index without checking
+# the catalog version (autocomplete only).
+CATALOG_INDEX_MAX_AGE = 10
+
+# Seconds during which browsers and proxies may reuse an autocomplete
+# response without revalidating it against the catalog version (ETag).
+AUTOCOMPLETE_MAX_AGE = 60 * 60
+
+# Progress of the refresh commands, to resume them with --resume.
+REFRESH_CHECKPOINT_DIR = os.path.join(BASE_DIR, 'refresh_logs', 'checkpoints')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -28,6 +28,7 @@ urlpatterns = [
     url(r'^$', openfood_views.search_product, name='search_product'),
     url(r'^produits/', include('openfood.urls')),
     url(r'^api/get_products/', openfood_views.get_products, name='get_products'),
+    url(r'^api/substitutes/$', openfood_views.batch_substitutes, name='batch_substitutes'),
     url(r'^inscription/', openuser_views.registration, name='registration'),
     url(r'^connexion/', openuser_views.log_in, name='log_in'),
     url(r'^deconnexion/', openuser_views.log_out, name='log_out'),